@@ -165,6 +165,70 @@ Note
  * Block closing '<?}?>' is required.
 
 
+Macros
+~~~~~~
+
+A `def` block defines a macro, the output of a macro called by '<?=...?>' is
+streamed inline::
+
+    >>> print(render_string('''<?py
+    ...         from katagami import trim_blocks
+    ...     ?>
+    ... <? def row(name, value) {?>
+    ... <tr><th><?=name?></th><td><?=value?></td></tr><?}?>
+    ... <table>
+    ... <?=row('a', '1')?>
+    ... <?=row('b', '2')?>
+    ... </table>''').strip())
+    <table>
+    <tr><th>a</th><td>1</td></tr>
+    <tr><th>b</th><td>2</td></tr>
+    </table>
+
+
+Trimming
+~~~~~~~~
+
+Set the `trim_blocks` feature to remove the indentation and the line break of
+lines which have only block or script PIs::
+
+    >>> print(render_string('''<?py
+    ...         from katagami import trim_blocks
+    ...     ?>
+    ... <html>
+    ... <body>
+    ...     <? for name in names: {?>
+    ...         <p>hello, <?=name?></p>
+    ...     <?}?>
+    ... </body>
+    ... </html>''', {'names': ['world', 'python']}))
+    <html>
+    <body>
+            <p>hello, world</p>
+            <p>hello, python</p>
+    </body>
+    </html>
+
+
+Internationalization
+--------------------
+
+`<?_message?>` is translated when the template is compiled with
+`translations` (`gettext.NullTranslations` or its subclass), so the
+translated text is a constant of the compiled template. `<?_=expression?>`
+is translated on rendering by `__gettext__` of the context or `translations`::
+
+    >>> class Translations(gettext.NullTranslations):
+    ...     def gettext(self, message):
+    ...         return {'Hello': 'Bonjour'}.get(message, message)
+    >>> template = '<p><?_Hello?>, <?_=name?></p>'
+    >>> renderer = Translator(io.StringIO(template), Translations())
+    >>> print(renderer({'name': 'Hello'}))
+    <p>Bonjour, Bonjour</p>
+    >>> print(render_string(template, {'name': 'world'}))
+    <p>Hello, world</p>
+
+
 Iteratable rendering
 --------------------
 
@@ -176,6 +240,29 @@ Render with iteration::
     >>> print(list(renderer))
     ['<html><body>\n    <p>hello, ', 'world', '</p>\n    </body></html>']
 
+Set the `fuse_yields` feature to join literals and expressions into one
+chunk. The type check and `cast_string` are applied to each expression::
+
+    >>> renderer = render_string('''<?py
+    ...         from katagami import fuse_yields
+    ...     ?><p>hello, <?= name ?></p>''', {'name': 'world'},
+    ...     flags=returns_iter)
+    >>> print(list(renderer))
+    ['<p>hello, world</p>']
+
+Set the `fuse_loops` feature to render a `for` block of only literals,
+expressions and such blocks by one format operation per item. The items are
+joined in batches of `Translator.loop_batch_size`. This implies
+`fuse_yields`, and the loop variables are not left after the block::
+
+    >>> renderer = render_string('''<?py
+    ...         from katagami import fuse_loops
+    ...     ?><? for row in rows: {?><tr><? for c in row: {?>'''
+    ...     '''<td><?=c?></td><?}?></tr><?}?>''',
+    ...     {'rows': [['a', 'b'], ['c']]}, flags=returns_iter)
+    >>> print(list(renderer))
+    ['<tr><td>a</td><td>b</td></tr><tr><td>c</td></tr>']
+
 
 Encoding detection
 ------------------
@@ -208,7 +295,7 @@ Get the translated result::
     ...     </body></html>''',
     ...     flags=returns_renderer)
     >>> print(renderer.script)
-    __file__ = "<template-script#0>"
+    __file__ = "<template-script#67d702de21bdf275>"
     __encoding__ = "utf-8"
     def __main__():
         yield "<html><body>\n    <p>"
@@ -257,6 +344,21 @@ import os
 import os.path
 import re
 import io
+import ast
+import zlib
+import struct
+import types
+import bisect
+import errno
+import inspect
+import time
+import hashlib
+import linecache
+import weakref
+import gettext
+import marshal
+import codecs
+import itertools
 import tokenize
 import pprint
 import unicodedata
@@ -271,6 +373,11 @@ __all__ = (
     'returns_bytes',
     'returns_iter',
     'returns_renderer',
+    'returns_gzip',
+    'TemplateApp',
+    'RenderLimitError',
+    'IncrementalRenderer',
+    'MemoizedRenderer',
     )
 
 
@@ -280,15 +387,31 @@ __all__ = (
 features = (
     'cast_string',
     'except_hook',
+    'trim_blocks',
+    'minify_html',
+    'fuse_yields',
+    'fuse_loops',
     )
 TAB = '    '
 PREFIX, SUFFIX = '<?', '?>'
 returns_bytes = 1
 returns_iter = 2
 returns_renderer = 4
+returns_gzip = 8
 cast_string = 10
 except_hook = 20
+trim_blocks = 64
+minify_html = 128
+fuse_yields = 256
+fuse_loops = 512
 notgiven = object()
+_clock = getattr(time, 'monotonic', time.time)
+try:
+    from importlib.util import MAGIC_NUMBER as _magic_number
+except ImportError:
+    import imp; _magic_number = imp.get_magic(); del imp
+# pickled code objects are loaded only if this matches
+_pickle_tag = (__version__, _magic_number)
 
 
 #
@@ -415,7 +538,8 @@ class PrettyPrinter(pprint.PrettyPrinter):
         elif isinstance(object, BytesType):
             return py3_repr_bytes(object), True, False
 
-        return pprint._safe_repr(object, context, maxlevels, level)
+        return pprint.PrettyPrinter.format(
+            self, object, context, maxlevels, level)
 
 
 def dprint(object):
@@ -443,6 +567,437 @@ def literalize(s):
     return '"%s"' % s.encode('unicode_escape').decode().replace('"', '\\"')
 
 
+def advance_position(position, text):
+    r"""Get the position after `text` which starts from `position`.
+
+    >>> advance_position((1, 0), 'abc')
+    (1, 3)
+    >>> advance_position((1, 3), 'de\nfg\r\nh')
+    (3, 1)
+    >>> advance_position((2, 5), 'xyz\n')
+    (3, 0)
+    """
+    lines = text.splitlines(True)
+    if not lines:
+        return position
+
+    line, column = position
+    last = lines[-1]
+    if last.splitlines()[0] != last:
+        return line + len(lines), 0
+    elif len(lines) == 1:
+        return line, column + len(last)
+    else:
+        return line + len(lines) - 1, len(last)
+
+
+_string_end_patterns = dict(
+    (quote, re.compile(r'(?:\\.|[^\\])*?' + quote, re.DOTALL))
+    for quote in ("'''", '"""', "'", '"'))
+_python_special_pattern = re.compile(
+    r"""'''|\"\"\"|['"#()\[\]{}]|\\$""")
+
+
+def logical_lines(source):
+    r"""Split Python source into logical lines without tokenization.
+
+    Yields `(lineno, line)`. A logical line continued by brackets,
+    backslashes or multiline strings is yielded at once with its newlines.
+
+    >>> source = 'a = (1,\n    2) # )\nb = "(" + \\\n    "\\")"\nc'
+    >>> for lineno, line in logical_lines(source):
+    ...     print(lineno, repr(line))
+    1 'a = (1,\n    2) # )'
+    3 'b = "(" + \\\n    "\\")"'
+    5 'c'
+    """
+    chunk, chunk_lineno = [], 1
+    depth, string, continued = 0, None, False
+
+    for lineno, line in enumerate(re.split('\r\n|\r|\n', source)):
+        if not chunk:
+            chunk_lineno = lineno + 1
+        chunk.append(line)
+        continued = False
+
+        pos = 0
+        while pos < len(line):
+            # inside a string, find the closing quote
+            if string:
+                matched = _string_end_patterns[string].match(line, pos)
+                if matched:
+                    pos = matched.end()
+                    string = None
+                    continue
+                if len(string) == 1 and not line.endswith('\\'):
+                    string = None # unterminated, leave it to compiler
+                break
+
+            matched = _python_special_pattern.search(line, pos)
+            if not matched:
+                break
+            token = matched.group(0)
+            pos = matched.end()
+            if token == '#':
+                break
+            elif token == '\\':
+                continued = True
+            elif token in '([{':
+                depth += 1
+            elif token in ')]}':
+                depth = max(depth - 1, 0)
+            else:
+                string = token
+
+        if not (depth or string or continued):
+            yield chunk_lineno, '\n'.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield chunk_lineno, '\n'.join(chunk)
+
+
+except_hook_script = (
+    'try:',
+    TAB + 'yield %(expr)s',
+    'except:',
+    TAB + "if '__except_hook__' in locals():",
+    TAB * 2 + "yield locals()['__except_hook__'](",
+    TAB * 3 + "*__import__('sys').exc_info())",
+    TAB + "elif '__except_hook__' in globals():",
+    TAB * 2 + "yield globals()['__except_hook__'](",
+    TAB * 3 + "*__import__('sys').exc_info())",
+    TAB + 'else:',
+    TAB * 2 + "yield %(str)s(__import__('sys').exc_info()[1])",
+    )
+
+
+if hasattr(ast, 'Constant'):
+    _constant_nodes = ('Constant', )
+else:
+    _constant_nodes = ('Str', 'Num', 'Bytes', 'NameConstant')
+_foldable_nodes = tuple(getattr(ast, i) for i in _constant_nodes + (
+    'Expression', 'Load', 'Tuple', 'IfExp', 'JoinedStr', 'FormattedValue',
+    'BinOp', 'Add', 'UnaryOp', 'Not', 'BoolOp', 'And', 'Or', 'Compare',
+    'Eq', 'NotEq', 'In', 'NotIn', 'Is', 'IsNot') if hasattr(ast, i))
+_foldable_pattern = re.compile('^[rRbBuUfF]*[\'"(]')
+
+
+def fold_constant(expr):
+    r"""Evaluate an expression at compile time if it is made of literals.
+
+     * `return` -- the value if it is a string, otherwise `None`
+
+    >>> dprint(fold_constant('"a" + \'b\''))
+    ab
+    >>> dprint(fold_constant('("x" if 1 else "y") + f"{\'z\'}"'))
+    xz
+    >>> [fold_constant(i) for i in ('"a" + name', '"a" * 3', '1')]
+    [None, None, None]
+    """
+    # NOTE: multiplication and formatting are not allowed, those can make
+    #       huge strings from small literals.
+    if not _foldable_pattern.match(expr):
+        return None
+
+    try:
+        tree = ast.parse(expr, mode='eval')
+    except SyntaxError:
+        return None
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _foldable_nodes) \
+           or getattr(node, 'format_spec', None) is not None:
+            return None
+
+    try:
+        value = eval(compile(tree, '<constant>', 'eval'), {'__builtins__': {}})
+    except Exception:
+        return None
+
+    if type(value) is StringType:
+        return value
+
+
+_linebreak_pattern = re.compile('\r\n|\r|\n')
+
+
+class _Blank(StringType):
+    """Literal whitespace which `trim_blocks` feature removes."""
+
+
+class _Value(StringType):
+    """Literal output of a PI, e.g. a folded constant or a translated
+    message, which `minify_html` feature keeps as is."""
+
+
+def _load_translations(domain, localedir=None, languages=None):
+    """gettext.translation() which remembers its arguments, so that a
+    pickled Translator loads the same catalog again."""
+    translations = gettext.translation(domain, localedir, languages,
+                                       fallback=True)
+    translations._katagami_catalog = domain, localedir, languages
+    return translations
+
+
+class _MessageCatalog(dict):
+    """Translations of a pickled Translator, see `Translator.__getstate__()`.
+    """
+
+    def gettext(self, message):
+        return self.get(message, message)
+
+    ugettext = gettext
+
+
+# weak references to translators of each anonymous template in linecache
+_source_owners = {}
+
+
+def _release_source(name, ref):
+    """Remove an anonymous template from linecache when its last
+    translator is collected."""
+    owners = _source_owners.get(name)
+    if owners is None:
+        return
+    owners.discard(ref)
+    if not owners:
+        del _source_owners[name]
+        linecache.cache.pop(name, None)
+
+
+class _Expression(object):
+    """Inline expression which `fuse_yields` feature joins with literals."""
+    __slots__ = ('expr', 'marker')
+
+    def __init__(self, expr, marker):
+        self.expr = expr
+        self.marker = marker
+
+
+class _Loop(object):
+    """`for` block which `fuse_loops` feature renders in batches."""
+    __slots__ = ('target', 'iter', 'depth', 'start', 'marker', 'items',
+                 'pure')
+
+    def __init__(self, target, iter, depth, start, marker):
+        self.target = target
+        self.iter = iter
+        self.depth = depth
+        self.start = start
+        self.marker = marker
+        self.items = []
+        self.pure = True
+
+
+def _batches(iterable, size):
+    """Split items of a loop fused by `fuse_loops` into lists."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _check_string(value):
+    """Type check of an expression fused by `fuse_yields`."""
+    if not isinstance(value, StringType):
+        raise TypeError('Can\'t convert \'%s\' object to %s implicitly' % (
+            type(value).__name__, StringType.__name__))
+    return value
+
+
+def _cast_string(value, cast):
+    """Conversion of an expression fused by `fuse_yields` with
+    `cast_string`."""
+    return value if isinstance(value, StringType) else cast(value)
+
+
+class RenderLimitError(Exception):
+    """Rendering exceeded `timeout` or `max_output`.
+
+    `filename`, `lineno` and `offset` are the template position where the
+    rendering was stopped.
+    """
+
+    def __init__(self, msg, filename=None, lineno=None, offset=None):
+        Exception.__init__(self, msg, filename, lineno, offset)
+        self.msg = msg
+        self.filename = filename
+        self.lineno = lineno
+        self.offset = offset
+
+    def __str__(self):
+        return '%s (%s, line %s)' % (self.msg, self.filename, self.lineno)
+
+
+# frames of these are hidden from tracebacks of templates
+_helper_codes = (_check_string.__code__, _cast_string.__code__)
+
+
+_minify_pattern = re.compile(r'''
+    (?P<comment><!--(?!\[if).*?-->)
+    | (?P<open><!--|<(?P<tag>pre|textarea|script|style)\b)
+    | (?P<element><[a-zA-Z/!][^<>]*>?)
+    | (?P<space>\s+)
+    ''', re.IGNORECASE | re.DOTALL | re.VERBOSE)
+
+
+def minify_literal(string, state=None):
+    r"""Minify a literal chunk of HTML.
+
+    Whitespace is collapsed and comments are removed. Tags and contents of
+    pre, textarea, script and style elements and conditional comments are
+    kept as is, also a tag which continues to the next chunk.
+
+     * `state` -- the state returned by the previous chunk
+     * `return` -- (minified string, state for the next chunk)
+
+    >>> string, state = minify_literal('''<p  class="a">
+    ...     hello,   <!-- comment -->world
+    ... </p><PRE> 1
+    ...   2 </pre>  <script>if (a  < b)''')
+    >>> dprint(string)
+    <p  class="a">
+    hello, world
+    </p><PRE> 1
+      2 </pre> <script>if (a  < b)
+    >>> dprint(minify_literal('''  </script>  <b>''', state)[0])
+      </script> <b>
+    >>> string, state = minify_literal('''<input value="''')
+    >>> dprint(minify_literal('''  a  ">  b''', state)[0])
+      a  "> b
+    """
+    result = []
+    pos = 0
+
+    while pos < len(string):
+        # inside a tag, find the end of it out of quoted values
+        if state in ('>', '"', "'"):
+            quote = None if state == '>' else state
+            end = pos
+            while end < len(string):
+                char = string[end]
+                if quote:
+                    if char == quote:
+                        quote = None
+                elif char in '"\'':
+                    quote = char
+                elif char == '>':
+                    break
+                end += 1
+            if end == len(string):
+                result.append(string[pos:])
+                state = quote or '>'
+                break
+            result.append(string[pos:end + 1])
+            pos = end + 1
+            state = None
+            continue
+
+        # inside raw text element or comment, find the end of it
+        if state:
+            matched = re.compile(re.escape(state), re.IGNORECASE) \
+                        .search(string, pos)
+            if not matched:
+                result.append(string[pos:])
+                break
+            result.append(string[pos:matched.end()])
+            pos = matched.end()
+            state = None
+            continue
+
+        matched = _minify_pattern.search(string, pos)
+        if not matched:
+            result.append(string[pos:])
+            break
+        result.append(string[pos:matched.start()])
+        pos = matched.end()
+
+        if matched.group('space'):
+            result.append('\n' if '\n' in matched.group('space') else ' ')
+        elif matched.group('element'):
+            if matched.end() == len(string) \
+               and not matched.group('element').endswith('>'):
+                # the tag continues to the next chunk
+                state = '>'
+                pos = matched.start()
+                continue
+            result.append(matched.group('element'))
+        elif matched.group('open'):
+            result.append(matched.group('open'))
+            if matched.group('tag'):
+                state = '</' + matched.group('tag')
+            else:
+                state = '-->'
+
+    return StringType().join(result), state
+
+
+def _strip_comments(expr):
+    """Strip comments and whitespace of an inline expression."""
+    if '#' in expr:
+        tokens = PythonTokens.from_string(expr)
+        tokens.strip_comments()
+        expr = tokens.untokenize()
+    return expr.strip()
+
+
+_marker_pattern = re.compile(
+    r'\s*# -\*- line (?P<line>\d+), column (?P<column>\d+) -\*-\s*')
+
+
+def _iter_attributes(object):
+    """Iterate (name, value) of attributes in __slots__ and __dict__."""
+    for cls in type(object).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            if name not in ('__dict__', '__weakref__') \
+               and hasattr(object, name):
+                yield name, getattr(object, name)
+    for item in getattr(object, '__dict__', {}).items():
+        yield item
+
+
+def _is_source_file(name):
+    """Whether the template source `name` can be read again from the file
+    system, which is not the case for e.g. a member of ArchiveLoader."""
+    return name is not None and not name.startswith('<') \
+        and os.path.isfile(name)
+
+
+def _intern_constants(code):
+    """Intern str constants of a code object and its nested code objects."""
+    if not hasattr(code, 'replace'): # Python < 3.8
+        return code
+    return code.replace(co_consts=tuple(
+        _intern_constants(i) if isinstance(i, types.CodeType) else
+        sys.intern(i) if type(i) is str else
+        i for i in code.co_consts))
+
+
+def _getsizeof_deep(object, seen):
+    """`sys.getsizeof()` including referred objects, each is counted once."""
+    if id(object) in seen:
+        return 0
+    seen.add(id(object))
+
+    size = sys.getsizeof(object)
+    if isinstance(object, (tuple, list, set, frozenset)):
+        children = object
+    elif isinstance(object, dict):
+        children = itertools.chain(object.keys(), object.values())
+    elif isinstance(object, types.CodeType):
+        children = [getattr(object, i) for i in dir(object)
+                    if i.startswith('co_')
+                    and not callable(getattr(object, i))]
+    elif isinstance(object, Translator):
+        children = [value for _, value in _iter_attributes(object)]
+    else:
+        children = ()
+    return size + sum(_getsizeof_deep(i, seen) for i in children)
+
+
 def decorate_attributes(**kwargs):
     """attributes decorator"""
     def result(function):
@@ -658,9 +1213,59 @@ def get_encodings_from_content(bytes):
 
 class Translator(object):
     # TODO: subclass or wrap or extend or inherit template...
-    _name_counter = 0
+    # the template is read, decoded and scanned by blocks of this size
+    read_size = 1024 * 64
+    # the decoded template is kept for error reporting only if it is shorter
+    # than this, otherwise the lines are read again from the file
+    max_source_size = 1024 * 1024
+    # rendered chunks are joined up to this size by `render_to()`
+    write_size = 1024 * 8
+    # compression level of returns_gzip
+    gzip_level = 6
+    # literal chunks longer than this are compressed once for returns_gzip
+    gzip_segment_size = 1024 * 4
+    # items of a loop fused by `fuse_loops` are joined up to this count
+    loop_batch_size = 256
+
+    __slots__ = (
+        'name',
+        'encoding',
+        'features',
+        'code',
+        'mtime', # set by KatagamiTemplate
+        '_script',
+        '_template_body',
+        '_source_map',
+        '_parameters',
+        'translations',
+        '_messages',
+        '_gzip_segments',
+        '__weakref__',
+        # tunables and attributes set by users
+        '__dict__',
+        # used only while compiling
+        '_source_blocks',
+        '_lines',
+        '_literal',
+        '_literal_size',
+        '_marker',
+        '_minify_state',
+        '_indent',
+        '_current_position',
+        '_firstmost_executable',
+        '_handlers',
+        '_signature',
+        '_macros',
+        '_loops',
+        )
+
+    def __init__(self, file, translations=None):
+        """Compile a template.
 
-    def __init__(self, file):
+         * `file` -- file-like object
+         * `translations` -- gettext.NullTranslations for <?_message?>
+        """
+        self.translations = translations
         self._makescript(file)
 
         try:
@@ -672,21 +1277,288 @@ class Translator(object):
                 e.filename,
                 lineno,
                 offset,
-                self._template_body.splitlines()[lineno - 1],
+                self._get_template_line(lineno),
                 ))
             new_exception.__cause__ = e
             raise new_exception
 
-    def __call__(self, context, flags=0):
+        self._register_source()
+
+    def __getstate__(self):
+        """Pickle the code object by marshal.
+
+        The compiled code is valid only with the same katagami and the same
+        bytecode, `__setstate__()` compiles the template again otherwise.
+        """
+        state = dict(_iter_attributes(self))
+        # precompressed segments are rebuilt on demand
+        state.pop('_gzip_segments', None)
+        state['code'] = marshal.dumps(self.code)
+        # catalogs may not be picklable, the catalog of KatagamiTemplate is
+        # loaded again, other ones keep messages used on compiling
+        catalog = getattr(self.translations, '_katagami_catalog', None)
+        if catalog is not None:
+            state['translations'] = None
+            state['_katagami_catalog'] = catalog
+        elif self.translations is not None:
+            state['translations'] = _MessageCatalog(self._messages)
+        state['_pickle_tag'] = _pickle_tag
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        catalog = state.pop('_katagami_catalog', None)
+        if catalog is not None:
+            state['translations'] = _load_translations(*catalog)
+        if state.pop('_pickle_tag', None) != _pickle_tag:
+            self._recompile(state)
+            return
+
+        for key, value in state.items():
+            setattr(self, key, value)
+        self.code = marshal.loads(state['code'])
+        self._register_source()
+
+    def _recompile(self, state):
+        """Compile the template of a pickled translator from its source."""
+        logger.debug('recompiling pickled template %s', state['name'])
+        self.name = state['name']
+        self.encoding = state['encoding']
+        self._template_body = state['_template_body']
+        with self._open_source() as fp:
+            self.__init__(fp, state.get('translations'))
+
+        # restore attributes set by users, e.g. mtime of KatagamiTemplate
+        for key, value in state.items():
+            if key not in Translator.__slots__ or not hasattr(self, key):
+                setattr(self, key, value)
+
+    def _open_source(self):
+        """Open the template source again."""
+        body = self._template_body
+        if body is None:
+            if self.name.startswith('<'):
+                raise OSError(errno.ENOENT, 'template source is not kept',
+                              self.name)
+            return open(self.name, 'rb')
+
+        file = io.BytesIO(body.encode(self.encoding))
+        if not self.name.startswith('<'):
+            file.name = self.name
+        return file
+
+    @property
+    def script(self):
+        """The generated script, which is made again after `compact()`."""
+        if self._script is None:
+            with self._open_source() as fp:
+                return type(self)(fp, self.translations)._script
+        return self._script
+
+    @script.setter
+    def script(self, script):
+        self._script = script
+
+    def compact(self):
+        """Reduce memory used by a cached translator.
+
+        The template source and the script are dropped, they are read again
+        for error messages. The source which is not a file, e.g. of an
+        anonymous template, is kept because it can't be read again. Literal
+        constants are interned so that the same chunks of different
+        templates share memory.
+
+         * `return` -- self
+        """
+        if _is_source_file(self.name):
+            self._template_body = None
+        self._script = None
+        self.code = _intern_constants(self.code)
+        return self
+
+    def memory_usage(self):
+        """Estimate bytes used by this translator with `sys.getsizeof()`.
+
+        Objects shared with other translators, e.g. interned constants, are
+        counted for each of them.
+        """
+        return _getsizeof_deep(self, set())
+
+    def _register_source(self):
+        # make the source of an anonymous template visible in tracebacks
+        # while a translator of it is alive
+        if self.name.startswith('<') and self._template_body is not None:
+            linecache.cache[self.name] = (
+                len(self._template_body), None,
+                self._template_body.splitlines(True), self.name)
+            name = self.name
+            _source_owners.setdefault(name, set()).add(weakref.ref(
+                self, lambda ref: _release_source(name, ref)))
+
+    def __call__(self, context, flags=0, timeout=None, max_output=None,
+                 gzip_level=None):
         """Execute the template script.
 
          * `context` -- dict. Execution namespace. Note that this argument is
                         changed on rendering.
          * `flags` -- Change output behavior. This value is combination of
-                      returns_bytes or returns_iter.
+                      returns_bytes or returns_iter or returns_gzip.
+         * `timeout` -- seconds to render
+         * `max_output` -- maximum length of the output in characters, or in
+                           bytes with returns_bytes (before compression)
+         * `gzip_level` -- compression level of returns_gzip, `gzip_level`
+                           attribute by default
          * `return` -- str or bytes or generator. See `flags`.
+
+        RenderLimitError is raised when a limit is exceeded. The limits are
+        checked for each chunk, a long computation which doesn't output is
+        not interrupted.
+        """
+        return self._render(context, flags, None, timeout, max_output,
+                            gzip_level)
+
+    def render_to(self, sink, context, flags=0, buffer_size=None,
+                  timeout=None, max_output=None, gzip_level=None):
+        """Render the template and write it into `sink`.
+
+         * `sink` -- an object which has `write()`, `sendall()` or
+                     `writelines()`, or a bytearray. io.TextIOBase takes
+                     str, the others take bytes encoded by `encoding`.
+         * `context` -- same as `__call__()`
+         * `flags` -- 0 or returns_gzip
+         * `buffer_size` -- chunks are joined and written at once after this
+                            size, 0 writes each chunk. `write_size` by
+                            default.
+         * `timeout`, `max_output`, `gzip_level` -- same as `__call__()`
+         * `return` -- number of written characters or bytes
+
+        >>> sink = bytearray()
+        >>> template = render_string('<?="\u00e9"?>', flags=returns_renderer)
+        >>> template.render_to(sink, {})
+        2
+        >>> dprint(sink.decode('utf-8'))
+        \u00e9
+        """
+        if isinstance(sink, bytearray):
+            write = sink.extend
+        elif hasattr(sink, 'write'):
+            def write(data):
+                # a raw stream may write a part of data
+                size = sink.write(data)
+                while size is not None and size < len(data):
+                    if not isinstance(data, memoryview):
+                        data = memoryview(data)
+                    data = data[size:]
+                    size = sink.write(data)
+        elif hasattr(sink, 'sendall'):
+            write = sink.sendall
+        elif hasattr(sink, 'writelines'):
+            write = lambda data: sink.writelines((data, ))
+        else:
+            raise TypeError('%r is not supported sink' % sink)
+
+        text = isinstance(sink, io.TextIOBase)
+        if flags & returns_gzip:
+            if text:
+                raise TypeError('gzip stream can\'t be written as text')
+            join, encode = BytesType().join, False
+        else:
+            join, encode = StringType().join, not text
+        if buffer_size is None:
+            buffer_size = self.write_size
+
+        chunks = self._render(context, flags & returns_gzip | returns_iter,
+                              None, timeout, max_output, gzip_level)
+        written = buffered = 0
+        buffer = []
+        try:
+            for chunk in itertools.chain(chunks, (None, )):
+                if chunk is not None:
+                    buffer.append(chunk)
+                    buffered += len(chunk)
+                    if buffered < buffer_size:
+                        continue
+                if buffer:
+                    data = join(buffer)
+                    if encode:
+                        data = data.encode(self.encoding)
+                    write(data)
+                    written += len(data)
+                    del buffer[:]
+                    buffered = 0
+        finally:
+            chunks.close()
+
+        return written
+
+    def render_many(self, contexts, flags=0, base={}, workers=None,
+                    ordered=True, chunksize=64):
+        """Render the template with many contexts lazily.
+
+        The template script is executed once and its function is reused for
+        each context, which is laid over a copy of `base`.
+
+         * `contexts` -- iterable of dict
+         * `flags` -- same as `__call__()`
+         * `base` -- variables shared by all renderings
+         * `workers` -- number of worker processes. `None`, 0 or 1 renders
+                        in this process. The results are sent back from
+                        the workers, so returns_iter is ignored with them.
+         * `ordered` -- if false, results are generated as soon as they are
+                        rendered as (index of the context, result) pairs.
+         * `chunksize` -- number of contexts sent to a worker at once
+         * `return` -- generator of results, see `__call__()`
+
+        >>> template = render_string('<?=name?>', flags=returns_renderer)
+        >>> dprint(list(template.render_many([{'name': 'a'}, {'name': 'b'}])))
+        ['a', 'b']
+        """
+        if workers is not None and workers > 1:
+            return _render_parallel(self, contexts, flags, base, workers,
+                                    ordered, chunksize)
+        return self._render_many(contexts, flags, base, ordered)
+
+    def _render_many(self, contexts, flags, base, ordered=True):
+        namespace, function = self._prepare_many(base)
+        for index, context in enumerate(contexts):
+            result = self._render(dict(namespace, **context), flags, function)
+            yield result if ordered else (index, result)
+
+    def _prepare_many(self, base):
+        """Execute the script once for `_render()` with `function`.
+
+         * `return` -- (namespace, __main__ function)
         """
-        result = self._exectamplate(context, flags)
+        namespace = dict(base)
+        self._install_gettext(namespace)
+        execcode(self.code, namespace)
+        return namespace, namespace['__main__']
+
+    def _install_gettext(self, namespace):
+        """Give `translations` for <?_=expression?> unless the namespace
+        has `__gettext__`."""
+        if '__gettext__' not in namespace:
+            if self.translations is None:
+                namespace['__gettext__'] = StringType
+            else:
+                namespace['__gettext__'] = getattr(
+                    self.translations, 'ugettext', self.translations.gettext)
+
+    def _render(self, context, flags=0, function=None, timeout=None,
+                max_output=None, gzip_level=None):
+        if flags & returns_gzip:
+            if gzip_level is None:
+                gzip_level = self.gzip_level
+            result = gzip_iter(
+                self._exectamplate(context, flags & ~returns_bytes, function,
+                                   timeout, max_output),
+                gzip_level, self.encoding,
+                self._get_gzip_segments(gzip_level))
+            flags |= returns_bytes
+        else:
+            result = self._exectamplate(context, flags, function, timeout,
+                                        max_output)
+
         if flags & returns_iter:
             return result
         elif flags & returns_bytes:
@@ -694,6 +1566,26 @@ class Translator(object):
         else:
             return StringType().join(result)
 
+    def _get_gzip_segments(self, level):
+        """Get precompressed long literal chunks for `gzip_iter()`."""
+        try:
+            cache = self._gzip_segments
+        except AttributeError:
+            cache = self._gzip_segments = {}
+        if level not in cache:
+            segments = {}
+            codes = [self.code]
+            while codes:
+                for const in codes.pop().co_consts:
+                    if isinstance(const, types.CodeType):
+                        codes.append(const)
+                    elif isinstance(const, StringType) \
+                         and len(const) >= self.gzip_segment_size:
+                        segments[const] = compress_segment(
+                            const.encode(self.encoding), level)
+            cache[level] = segments
+        return cache[level]
+
     def _makescript(self, file):
         """make a script string from a template file
         
@@ -707,14 +1599,12 @@ class Translator(object):
             if not isinstance(file, io.IOBase):
                 raise TypeError('%r is not supported type' % file)
  
-        # read all
-        template_body = file.read()
-
-        # detect encoding
+        # detect encoding from the head of the template
+        head = file.read(self.read_size)
         encoding = getattr(file, 'encoding', '')
         if not encoding:
             try:
-                encoding = get_encodings_from_content(template_body)
+                encoding = get_encodings_from_content(head)
             except Exception:
                 logger.debug('encoding detection error', exc_info=True)
             # check encoding registered in Python
@@ -727,67 +1617,42 @@ class Translator(object):
             if encoding == 'ascii':
                 encoding = 'utf-8'
 
-        # cast string
-        if isinstance(template_body, BytesType):
-            template_body = template_body.decode(encoding)
-
         # save variables
-        if hasattr(file, 'name'):
-            self.name = file.name
-        else:
-            self.name = '<template-script#%d>' % self._name_counter
-            self._name_counter += 1
+        # NOTE: an anonymous template is named after its content hash by
+        #       `_readtemplate()` when the whole template has been read.
+        self.name = getattr(file, 'name', None)
         self.encoding = encoding
         self.features = 0
-        self._template_body = template_body
+        self._template_body = None
+        self._parameters = ()
+        self._messages = {}
 
         # loop vars
+        self._source_blocks = None
         self._lines = []
+        self._literal = []
+        self._literal_size = 0
+        self._marker = None
+        self._minify_state = None
         self._indent = []
         self._current_position = (1, 0)
         self._firstmost_executable = True
-        last = 0
-        pattern = re.compile(
-            re.escape(PREFIX) + '(?P<body>.*?)' + re.escape(SUFFIX), re.DOTALL)
-
-        for match in pattern.finditer(template_body):
-            start, end = match.span()
-
-            # get pos
-            _ = template_body[:start].splitlines()
-            self._current_position = (len(_), len(_[-1])) if _ else (1, 0)
-            del _
-
-            # leading chunk
-            chunk = template_body[last:start]
-            if chunk:
-                self._appendline('yield ' + literalize(chunk))
-            last = end
+        self._signature = None
+        self._macros = set()
+        self._loops = []
+        self._handlers = [getattr(self, i) for i in sorted(dir(self))
+                          if i.startswith('_handle_')]
+        blocks = self._readtemplate(file, head)
 
-            # insert marker
-            self._appendline(
-                '# -*- line %d, column %d -*-' % self._current_position)
-
-            # process PI
-            chunk = match.group('body')
-
-            for i in sorted(i for i in dir(self) if i.startswith('_handle_')):
-                handler = getattr(self, i)
-                if re.match(handler.pattern, chunk):
-                    handler(chunk)
-                    if getattr(handler, 'executable', True):
-                        self._firstmost_executable = False
-                    break
-
-            # not supported <?...?>
-            else:
-                chunk = PREFIX + chunk + SUFFIX
-                self._appendline('yield ' + literalize(chunk))
-
-        # trailing chunk
-        chunk = template_body[last:]
-        if chunk:
-            self._appendline('yield ' + literalize(chunk))
+        try:
+            self._translate(self._marklines(self._scantemplate(blocks)))
+        except SyntaxError as e:
+            if e.filename is None:
+                for _ in blocks:
+                    pass
+                e.filename = self.name
+            raise
+        self._flushliteral()
 
         # check remaining indentation
         if self._indent:
@@ -797,7 +1662,7 @@ class Translator(object):
                 self.name,
                 lineno,
                 offset,
-                self._template_body.splitlines()[lineno - 1],
+                self._get_template_line(lineno),
                 ))
 
         # make a script
@@ -805,46 +1670,297 @@ class Translator(object):
             '__file__ = %s' % literalize(self.name),
             # '__name__ = "__main__"',
             '__encoding__ = %s' % literalize(self.encoding),
-            # make a code as function for `yield` and `return`
-            'def __main__():',
             ]
+        if self.features & (fuse_yields | fuse_loops) \
+                and not self.features & except_hook:
+            if self.features & fuse_loops:
+                prefix.append('from %s import _batches as __batches__'
+                              % __name__)
+            if self.features & cast_string:
+                prefix.append('from %s import _cast_string as __to_string__'
+                              % __name__)
+                prefix.append("__cast_string__ = globals().get("
+                              "'__cast_string__', %s)" % StringType.__name__)
+            else:
+                prefix.append('from %s import _check_string as '
+                              '__check_string__' % __name__)
+        # make a code as function for `yield` and `return`
+        prefix.append('def __main__(%s):' % (self._signature or ''))
         if not self._lines:
             self._lines.insert(0, 'pass')
         self.script = '\n'.join(prefix) + '\n' \
                     + '\n'.join(TAB + i for i in self._lines)
 
+        # map script lines to template positions by markers
+        linenos, positions = [], []
+        for lineno, line in enumerate(self.script.split('\n')):
+            matched = _marker_pattern.match(line)
+            if matched:
+                linenos.append(lineno + 1) # lineno starts from 1
+                positions.append((int(matched.group('line')),
+                                  int(matched.group('column'))))
+        self._source_map = tuple(linenos), tuple(positions)
+
         # cleanup
+        del self._source_blocks
         del self._lines
+        del self._literal
+        del self._literal_size
+        del self._marker
+        del self._minify_state
         assert not self._indent
         del self._indent
         del self._current_position
         del self._firstmost_executable
+        del self._signature
+        assert not self._loops
+        del self._loops
+        del self._macros
+        del self._handlers
+
+    def _translate(self, events):
+        """Generate script lines from `_scantemplate()` events."""
+        for kind, chunk, position in events:
+            # literal chunk
+            if kind != 'pi':
+                self._appendliteral(chunk, kind == 'blank')
+                continue
+
+            # insert marker before the code of the PI
+            self._current_position = self._marker = position
 
-    def _exectamplate(self, context, flags=0):
-        # see https://github.com/mitsuhiko/jinja2/blob/master/jinja2/debug.py
-        # `Python 3.4.1 <http://hg.python.org/releasing/3.4/file/8671f89107c8/Python/traceback.c>`
-        # _Py_DisplaySourceLine -> io.open
-        # `Python 2.7.7 <http://hg.python.org/releasing/2.7.7/file/4b38a5a36536/Python/traceback.c>`
-        # _Py_DisplaySourceLine -> fopen
-        def _fix_error_pos(e):
-            filename, lineno, funcname, _ \
-                = traceback.extract_tb(sys.exc_info()[2])[-1]
+            # process PI
+            handler = self._findhandler(chunk)
+            if handler:
+                handler(chunk)
+                if getattr(handler, 'executable', True):
+                    self._firstmost_executable = False
 
-            if filename == self.name and funcname == '__main__':
-                lineno, offset = self._find_original_pos(lineno)
-                new_exception = type(e)(*e.args)
-                new_exception.__cause__ = e
-                code = compile('\n' * (lineno - 1) + 'raise new_exception',
-                               self.name, 'exec')
-                execcode(code, locals())
+            # not supported <?...?>
+            else:
+                self._appendliteral(PREFIX + chunk + SUFFIX)
 
-        # python2 doesn't allow using return and yield in same function
-        execcode(self.code, context)
+    def _findhandler(self, chunk):
+        for handler in self._handlers:
+            if re.match(handler.pattern, chunk):
+                return handler
+
+    def _marklines(self, events):
+        """Mark whitespace of the lines which have only block or script PIs
+        as 'blank' chunks, those are removed by `trim_blocks` feature.
+        """
+        pending = []
+        trimmable, found = True, False
+
+        for event in events:
+            kind, chunk, position = event
+
+            if kind == 'pi':
+                handler = self._findhandler(chunk)
+                if trimmable and getattr(handler, 'trimmable', False):
+                    pending.append(event)
+                    found = True
+                else:
+                    for i in pending:
+                        yield i
+                    pending, trimmable = [], False
+                    yield event
+                continue
+
+            # the first line break ends the current line
+            matched = _linebreak_pattern.search(chunk)
+            if not matched:
+                if trimmable and not chunk.strip():
+                    pending.append(event)
+                else:
+                    for i in pending:
+                        yield i
+                    pending, trimmable = [], False
+                    yield event
+                continue
+
+            head = chunk[:matched.end()]
+            if found and trimmable and not head.strip():
+                for i in pending:
+                    yield ('blank', ) + i[1:] if i[0] == 'literal' else i
+                yield 'blank', head, position
+            else:
+                for i in pending:
+                    yield i
+                yield 'literal', head, position
+
+            # following complete lines have no PI, the last line is new one
+            last = max(chunk.rfind('\n'), chunk.rfind('\r')) + 1
+            if last > matched.end():
+                yield 'literal', chunk[matched.end():last], position
+            pending, trimmable, found = [], True, False
+            if last < len(chunk):
+                if chunk[last:].strip():
+                    trimmable = False
+                    yield 'literal', chunk[last:], position
+                else:
+                    pending.append(('literal', chunk[last:], position))
 
-        executor = context['__main__']()
+        # the last line without line break
+        for i in pending:
+            if found and trimmable and i[0] == 'literal':
+                i = ('blank', ) + i[1:]
+            yield i
+
+    def _readtemplate(self, file, head):
+        """Iterate decoded blocks of a template file.
+
+         * `file` -- file-like object
+         * `head` -- the first block already read from `file`
+        """
+        if isinstance(head, BytesType):
+            decoder = codecs.getincrementaldecoder(self.encoding)()
+        else:
+            decoder = None
+        # the source read so far is visible to `_get_template_line()`, the
+        # source which is not a file is kept in whole because it can't be
+        # read again
+        anonymous = not _is_source_file(self.name)
+        source = self._source_blocks = []
+        size = 0
+        digest = hashlib.sha1()
+
+        block = head
+        while block:
+            if decoder:
+                block = decoder.decode(block)
+            if block:
+                digest.update(block.encode('utf-8', 'surrogatepass'))
+                if source is not None:
+                    size += len(block)
+                    source.append(block)
+                    if size > self.max_source_size and not anonymous:
+                        source = self._source_blocks = None
+                yield block
+            block = file.read(self.read_size)
+
+        if decoder:
+            block = decoder.decode(BytesType(), True)
+            if block:
+                digest.update(block.encode('utf-8', 'surrogatepass'))
+                if source is not None:
+                    source.append(block)
+                yield block
+
+        if source is not None:
+            self._template_body = StringType().join(source)
+        if self.name is None:
+            self.name = '<template-script#%s>' % digest.hexdigest()[:16]
+
+    def _scantemplate(self, blocks):
+        """Split decoded blocks into literal chunks and PI bodies.
+
+        Yields `('literal', literal, None)` or `('pi', body, position)`. Only
+        the unprocessed part of the template is buffered, long literal chunks
+        are split on line boundaries.
+        """
+        buffer, offset = StringType(), 0
+        position = (1, 0)
+
+        for block in itertools.chain(blocks, [None]):
+            if block is not None:
+                buffer = buffer[offset:] + block
+                offset = 0
+
+            while 1:
+                start = buffer.find(PREFIX, offset)
+                if start < 0:
+                    break
+                end = buffer.find(SUFFIX, start + len(PREFIX))
+                if end < 0:
+                    break
+
+                literal = buffer[offset:start]
+                position = advance_position(position, literal)
+                if literal:
+                    yield 'literal', literal, None
+
+                offset = end + len(SUFFIX)
+                yield 'pi', buffer[start + len(PREFIX):end], position
+                position = advance_position(position, buffer[start:offset])
+
+            # trailing chunk
+            if block is None:
+                if offset < len(buffer):
+                    yield 'literal', buffer[offset:], None
+                break
+
+            # flush the complete lines of a long literal chunk
+            if start < 0 and len(buffer) - offset > self.read_size:
+                cut = buffer.rfind('\n', offset) + 1
+                if cut <= offset:
+                    cut = len(buffer) - len(PREFIX) + 1
+                    if buffer[cut - 1] == '\r':
+                        cut -= 1
+                literal = buffer[offset:cut]
+                position = advance_position(position, literal)
+                offset = cut
+                yield 'literal', literal, None
+
+    def _get_template_line(self, lineno):
+        """Get a line of the template source for error messages."""
+        if self._template_body is not None:
+            lines = self._template_body.splitlines()
+        elif getattr(self, '_source_blocks', None) is not None:
+            # the template is being read
+            lines = StringType().join(self._source_blocks).splitlines()
+        elif self.name is None or self.name.startswith('<'):
+            return None
+        else:
+            # the template is too large to be kept, read the line again
+            try:
+                with io.open(self.name, encoding=self.encoding,
+                             newline='') as fp:
+                    lines = [line.rstrip('\r\n') for line in
+                             itertools.islice(fp, lineno - 1, lineno)]
+                    lineno = len(lines)
+            except Exception:
+                logger.debug('template reading error', exc_info=True)
+                return None
+
+        if 0 < lineno <= len(lines):
+            return lines[lineno - 1]
+
+    def _exectamplate(self, context, flags=0, function=None, timeout=None,
+                      max_output=None):
+        # python2 doesn't allow using return and yield in same function
+        if function is None:
+            self._install_gettext(context)
+            execcode(self.code, context)
+            function = context['__main__']
+        else:
+            # reuse __main__ of `_prepare_many()` with a new namespace
+            function, original = types.FunctionType(
+                function.__code__, context, '__main__',
+                function.__defaults__), function
+            if getattr(original, '__kwdefaults__', None):
+                function.__kwdefaults__ = original.__kwdefaults__
+
+        if self._parameters:
+            # declared by <?args ...?>
+            try:
+                executor = function(**dict((name, context[name])
+                                           for name in self._parameters
+                                           if name in context))
+            except TypeError as e:
+                # only binding of the parameters fails before iterating
+                raise TypeError(str(e).replace(
+                    '__main__()', 'template %s' % self.name))
+        else:
+            executor = function()
         # TODO: module['__main__'](**context) ?
         if executor is None: # The template is empty or that has only scripts.
-            raise StopIteration
+            return
+
+        limited = timeout is not None or max_output is not None
+        if limited:
+            deadline = _clock() + timeout if timeout is not None else None
+            output = 0
 
         # run (iterate) template code and fetch string chunks
         try:
@@ -854,7 +1970,7 @@ class Translator(object):
                     try:
                         value = next(executor)
                     except Exception as e:
-                        _fix_error_pos(e)
+                        self._fix_error_pos(e)
                         raise
 
                     # TODO: handle generator type
@@ -871,16 +1987,26 @@ class Translator(object):
                             continue
                 else:
                     try:
-                        value = executor.throw(
-                            TypeError,
+                        value = executor.throw(TypeError(
                             'Can\'t convert \'%s\' object to %s implicitly' % (
-                                type(value).__name__, StringType.__name__))
+                                type(value).__name__, StringType.__name__)))
                     except Exception as e:
-                        _fix_error_pos(e)
+                        self._fix_error_pos(e)
                         raise
 
                 if flags & returns_bytes:
                     value = value.encode(self.encoding)
+
+                if limited:
+                    output += len(value)
+                    if max_output is not None and output > max_output:
+                        raise self._limit_error(
+                            executor, 'output exceeded %d' % max_output)
+                    if deadline is not None and _clock() > deadline:
+                        raise self._limit_error(
+                            executor, 'rendering exceeded %s seconds'
+                                      % timeout)
+
                 yield value
 
                 value = notgiven
@@ -892,46 +2018,162 @@ class Translator(object):
             executor.close()
 
     def _appendline(self, line):
+        self._flushliteral()
+        # only literals and expressions are fused, see `_handle_block()`
+        if self._loops:
+            self._loops[-1].pure = False
+        if self._marker:
+            self._lines.append(TAB * len(self._indent)
+                               + '# -*- line %d, column %d -*-' % self._marker)
+            self._marker = None
         self._lines.append(TAB * len(self._indent) + line)
 
+    def _appendliteral(self, string, blank=False):
+        """Append a literal chunk, consecutive chunks are yielded at once.
+
+         * `blank` -- whitespace of a line which has only block or script
+                      PIs. This is removed if `trim_blocks` is enabled.
+        """
+        if string:
+            self._literal.append(_Blank(string) if blank else string)
+            self._literal_size += len(string)
+            if self._literal_size > self.read_size:
+                self._flushliteral()
+
+    def _flushliteral(self):
+        literal = self._literal
+        if self.features & trim_blocks:
+            literal = [i for i in literal if type(i) is not _Blank]
+
+        # join literals between expressions of `fuse_yields`, only the
+        # template text is minified
+        items = []
+        for kind, group in itertools.groupby(
+                literal, lambda i: type(i) if type(i) in (_Expression, _Value)
+                                   else StringType):
+            if kind is _Expression:
+                items.extend(group)
+                continue
+            string = StringType().join(group)
+            if kind is StringType and self.features & minify_html:
+                string, self._minify_state = minify_literal(
+                    string, self._minify_state)
+            if not string:
+                continue
+            if items and type(items[-1]) is not _Expression:
+                items[-1] += string
+            else:
+                items.append(string)
+        if self._loops and self._loops[-1].depth == len(self._indent):
+            self._loops[-1].items.extend(items)
+
+        indent = TAB * len(self._indent)
+        if len(items) == 1 and type(items[0]) is not _Expression:
+            self._lines.append(indent + 'yield ' + literalize(items[0]))
+
+        elif len(items) == 1:
+            # a lone expression is checked by `_exectamplate()`
+            if items[0].marker:
+                self._lines.append(indent + '# -*- line %d, column %d -*-'
+                                   % items[0].marker)
+            self._lines.append(indent + 'yield ' + items[0].expr)
+
+        elif items:
+            if self.features & cast_string:
+                convert = '__to_string__(%s, __cast_string__),'
+            else:
+                convert = '__check_string__(%s),'
+            self._lines.append(indent + 'yield "".join((')
+            for item in items:
+                if type(item) is not _Expression:
+                    self._lines.append(indent + TAB + literalize(item) + ',')
+                    continue
+                if item.marker:
+                    self._lines.append(indent + TAB
+                                       + '# -*- line %d, column %d -*-'
+                                       % item.marker)
+                self._lines.append(indent + TAB + convert % item.expr)
+            self._lines.append(indent + TAB + '))')
+
+        self._literal = []
+        self._literal_size = 0
+
     def _embedscript(self, script, posmarker=True):
-        tokens = PythonTokens.from_string(script)
+        lines = [(lineno, line, line.lstrip())
+                 for lineno, line in logical_lines(script)]
+
+        # the indentation of the firstmost code line is the top level
+        first_indent = ''
+        for lineno, line, stripped in lines:
+            if stripped and not stripped.startswith('#'):
+                first_indent = line[:len(line) - len(stripped)]
+                break
 
-        if posmarker:
-            _tokens = tokens
-            tokens = PythonTokens()
+        for lineno, line, stripped in lines:
+            # skip empty lines and comments
+            if not stripped or stripped.startswith('#'):
+                continue
 
-            for line in _tokens.linetokens:
-                pos = line[0][2]
-                if pos[0] == 1:
-                    pos = self._current_position[0] + pos[0] - 1, \
-                          self._current_position[1] + pos[1]
+            if posmarker:
+                if lineno == 1:
+                    pos = self._current_position
                 else:
-                    pos = self._current_position[0] + pos[0] - 1, pos[1]
-                tokens.append((tokenize.COMMENT,
-                               '# -*- line %d, column %d -*-' % pos))
-                tokens.append((tokenize.NL, '\n'))
-                tokens.extend(line)
-
-        tokens.set_indent(TAB * len(self._indent))
-        self._lines.extend(tokens.untokenize().splitlines())
+                    pos = self._current_position[0] + lineno - 1, \
+                          len(line) - len(stripped)
+                # the marker of the PI is replaced by that of each line
+                self._marker = None
+                self._appendline('# -*- line %d, column %d -*-' % pos)
+
+            # rewrite leading indentation only, continuation lines are kept
+            if line.startswith(first_indent):
+                line = line[len(first_indent):]
+            self._appendline(line)
+
+    def _limit_error(self, executor, msg):
+        """Make RenderLimitError at the current position of `executor`."""
+        lineno = offset = None
+        if executor.gi_frame is not None:
+            lineno, offset = self._find_original_pos(
+                executor.gi_frame.f_lineno)
+        return RenderLimitError(msg, self.name, lineno, offset)
 
     def _find_original_pos(self, lineno, column=0):
-        # find markers
-        pos = (lineno, 0)
-        pattern = re.compile(
-            '\s*# -\*- line (?P<line>\d+), column (?P<column>\d+) -\*-\s*')
-
-        for currrent_lineno, line in enumerate(self.script.splitlines()):
-            currrent_lineno += 1 # lineno starts from 1
-            matched = pattern.match(line)
-            if matched:
-                pos = (int(matched.group('line')),
-                       int(matched.group('column')))
-            if currrent_lineno >= lineno:
-                return pos
+        # find the last marker before the line
+        linenos, positions = self._source_map
+        index = bisect.bisect_right(linenos, lineno) - 1
+        if index < 0:
+            return lineno, 0
+        return positions[index]
+
+    def _remap_traceback(self, tb):
+        """Replace script line numbers of template frames in a traceback
+        with template line numbers. This doesn't compile any code nor read
+        any file.
+        """
+        entries = []
+        while tb is not None:
+            entries.append(tb)
+            tb = tb.tb_next
+
+        result = None
+        for tb in reversed(entries):
+            if tb.tb_frame.f_code in _helper_codes:
+                continue
+            lineno, lasti = tb.tb_lineno, tb.tb_lasti
+            if tb.tb_frame.f_code.co_filename == self.name:
+                lineno = self._find_original_pos(lineno)[0]
+                # NOTE: traceback module prefers the position of `tb_lasti`
+                lasti = -1
+            result = types.TracebackType(result, tb.tb_frame, lasti, lineno)
+        return result
 
-        raise ValueError()
+    def _fix_error_pos(self, e):
+        """Point template positions in the traceback of a exception."""
+        try:
+            e.with_traceback(self._remap_traceback(e.__traceback__))
+        except (AttributeError, TypeError):
+            # NOTE: TracebackType can't be made before Python 3.7
+            logger.debug('traceback remapping error', exc_info=True)
 
     # <?=...?>
     @decorate_attributes(pattern='^=')
@@ -947,6 +2189,11 @@ class Translator(object):
         >>> dprint(render_string('hello, <?= # comment\nname # hello ?>', {'name': 'world'}))
         hello, world
 
+        Constant expressions are merged into the literal at compile time:
+        >>> dprint(render_string('<p><?= "hello, " + \'world\' ?></p>',
+        ...     flags=returns_renderer).script.splitlines()[-1].strip())
+        yield "<p>hello, world</p>"
+
 
         Without cast_string, except_hook:
         >>> dprint(render_string('''
@@ -1035,32 +2282,56 @@ class Translator(object):
         >>> del default_context['__except_hook__']
         """
         # sanitize expression
-        tokens = PythonTokens.from_string(chunk[1:])
-        tokens.strip_comments()
-        expr = tokens.untokenize().strip()
+        expr = _strip_comments(chunk[1:])
+
+        # constant expression is merged into the surrounding literal
+        value = fold_constant(expr)
+        if value is not None:
+            self._appendliteral(_Value(value))
+
+        # the output of a macro is streamed
+        elif self._macros and self._is_macro_call(expr):
+            if sys.version < '3':
+                lines = ['for __chunk__ in (%s) or ():' % expr,
+                         TAB + 'yield __chunk__']
+            else:
+                # errors of type checks are thrown into the macro
+                lines = ['yield from (%s) or ()' % expr]
+            if self.features & except_hook:
+                # same as the other expressions, see below
+                lines = [except_hook_script[0]] \
+                      + [TAB + i for i in lines] \
+                      + [line % {'str': StringType.__name__}
+                         for line in except_hook_script[2:]]
+            for line in lines:
+                self._appendline(line)
 
         # except_hook is enabled
-        if self.features & except_hook:
-            self._embedscript('''
-                try:
-                    yield %s
-                except:
-                    if '__except_hook__' in locals():
-                        yield locals()['__except_hook__'](
-                            *__import__('sys').exc_info())
-                    elif '__except_hook__' in globals():
-                        yield globals()['__except_hook__'](
-                            *__import__('sys').exc_info())
-                    else:
-                        yield %s(__import__('sys').exc_info()[1])
-                ''' % (expr, StringType.__name__), posmarker=False)
+        elif self.features & except_hook:
+            for line in except_hook_script:
+                self._appendline(
+                    line % {'expr': expr, 'str': StringType.__name__})
+
+        # joined with the surrounding literals, see `_flushliteral()`
+        elif self.features & (fuse_yields | fuse_loops):
+            self._literal.append(_Expression(expr, self._marker))
+            self._marker = None
 
         # normal mode, except_hook is disabled
         else:
             self._appendline('yield ' + expr)
 
+    def _is_macro_call(self, expr):
+        try:
+            node = ast.parse(expr.strip(), mode='eval').body
+        except SyntaxError:
+            return False
+        return isinstance(node, ast.Call) \
+               and isinstance(node.func, ast.Name) \
+               and node.func.id in self._macros
+
     # <?py...?>
-    @decorate_attributes(pattern='^py')
+    @decorate_attributes(pattern='^py', trimmable=True)
     def _handle_embed_script(self, chunk):
         r"""Embed Python script.
 
@@ -1119,13 +2390,13 @@ class Translator(object):
             prefix = ' '.join(i[1] for i in firstline[:3])
             if prefix == 'from %s import' % __name__:
                 for token in firstline[3:]:
-                    if token[0] == tokenize.NAME and token[1] in self.features:
+                    if token[0] == tokenize.NAME and token[1] in features:
                         self.features |= globals()[token[1]]
 
         self._embedscript(chunk[2:])
 
     # <?}...{?>
-    @decorate_attributes(pattern='(^}|.*{$)')
+    @decorate_attributes(pattern='(^}|.*{$)', trimmable=True)
     def _handle_block(self, chunk):
         r"""Bridge Python and XML by brace.
 
@@ -1163,6 +2434,10 @@ class Translator(object):
         """
         if chunk.startswith('}'):
             chunk = chunk[1:]
+            self._flushliteral()
+            # the body is empty, e.g. whitespace is trimmed
+            if self._lines and self._lines[-1].endswith(':'):
+                self._lines.append(TAB * len(self._indent) + 'pass')
             try:
                 self._indent.pop()
             except LookupError:
@@ -1172,8 +2447,10 @@ class Translator(object):
                     self.name,
                     lineno,
                     offset,
-                    self._template_body.splitlines()[lineno - 1],
+                    self._get_template_line(lineno),
                     ))
+            if self._loops and self._loops[-1].depth > len(self._indent):
+                self._closeloop(self._loops.pop(), chunk.strip())
 
         indent = None
         if chunk.endswith('{'):
@@ -1182,12 +2459,166 @@ class Translator(object):
 
         chunk = chunk.strip()
         if chunk:
-            assert chunk.split()[0] not in ('def', 'class')
-            self._appendline(chunk)
+            assert chunk.split()[0] != 'class'
+            # macro, see `_handle_inline_expression()`
+            matched = re.match(r'def\s+(\w+)', chunk)
+            if matched:
+                self._macros.add(matched.group(1))
+                if not chunk.endswith(':'):
+                    chunk += ':'
+            matched = re.match(r'for\s+(.+?)\s+in\s+(.+):$', chunk)
+            if matched and indent and self.features & fuse_loops \
+                    and not self.features & except_hook:
+                self._flushliteral()
+                loop = _Loop(matched.group(1), matched.group(2),
+                             len(self._indent) + 1, len(self._lines),
+                             self._marker)
+                pure = self._loops and self._loops[-1].pure
+                self._appendline(chunk)
+                if self._loops:
+                    self._loops[-1].pure = pure
+                self._loops.append(loop)
+            else:
+                self._appendline(chunk)
 
         if indent:
             self._indent.append(indent)
 
+    def _closeloop(self, loop, continued):
+        """Replace a `for` block by a batched join if it has only literals,
+        expressions and such blocks, see `fuse_loops`."""
+        parent = self._loops[-1] if self._loops else None
+        if continued or not loop.pure:
+            if parent:
+                parent.pure = False
+            return
+        if parent:
+            parent.items.append(loop)
+
+        indent = TAB * len(self._indent)
+        del self._lines[loop.start:]
+        if loop.marker:
+            self._lines.append(indent + '# -*- line %d, column %d -*-'
+                               % loop.marker)
+        self._lines.append(indent + 'for __batch__ in __batches__(%s, %d):'
+                           % (loop.iter, self.loop_batch_size))
+        lines = self._fuseloop(loop, '__batch__')
+        lines[0] = 'yield ' + lines[0]
+        self._lines.extend(indent + TAB + i for i in lines)
+
+    def _fuseloop(self, loop, iterable):
+        """Make lines of an expression joining the items of a loop."""
+        if self.features & cast_string:
+            convert = '__to_string__(%s, __cast_string__),'
+        else:
+            convert = '__check_string__(%s),'
+        literals = all(type(i) not in (_Expression, _Loop) for i in loop.items)
+        form, args = [], []
+        for item in loop.items:
+            if type(item) is _Loop:
+                form.append('%s')
+                args.extend(self._fuseloop(item, item.iter))
+                args[-1] += ','
+            elif type(item) is _Expression:
+                form.append('%s')
+                if item.marker:
+                    args.append('# -*- line %d, column %d -*-' % item.marker)
+                if re.match(r'[^\d\W]\w*$', item.expr):
+                    # a name is checked inline without a call
+                    args.append('%s if type(%s) is %s else %s' % (
+                        item.expr, item.expr, StringType.__name__,
+                        convert % item.expr))
+                else:
+                    args.append(convert % item.expr)
+            else:
+                form.append(item if literals else item.replace('%', '%%'))
+        form = literalize(StringType().join(form))
+        if literals:
+            return ['"".join([%s for %s in %s])'
+                    % (form, loop.target, iterable)]
+        return (['"".join([%s %% (' % form]
+                + [TAB + i for i in args]
+                + [TAB + ') for %s in %s])' % (loop.target, iterable)])
+
+    # <?args...?>
+    @decorate_attributes(pattern='^args(\\s|$)', executable=False,
+                         trimmable=True)
+    def _handle_args(self, chunk):
+        r"""Declare parameters of the template.
+
+        The parameters are given from the context as local variables, which
+        are faster than global variables. A missing parameter without a
+        default value is an error.
+
+        >>> dprint(render_string('<?args name, greeting="hello"?>'
+        ...                      '<?=greeting?>, <?=name?>',
+        ...                      {'name': 'world'}))
+        hello, world
+        >>> render_string('<?args name?><?=name?>', {}) # doctest:+ELLIPSIS
+        Traceback (most recent call last):
+            ...
+        TypeError: template <template-script#...> missing ...: 'name'
+        """
+        signature = chunk[len('args'):].strip()
+        lineno, offset = self._current_position
+
+        error = None
+        if self._signature is not None:
+            error = 'parameters are already declared'
+        else:
+            try:
+                code = [i for i in compile(
+                    'def __main__(%s): pass' % signature, '<args>',
+                    'exec').co_consts if isinstance(i, types.CodeType)][0]
+            except SyntaxError as e:
+                error = 'invalid parameters: %s' % e.msg
+            else:
+                if code.co_flags & (inspect.CO_VARARGS
+                                    | inspect.CO_VARKEYWORDS):
+                    error = 'variable parameters are not supported'
+                # the parameters are given by keywords
+                elif getattr(code, 'co_posonlyargcount', 0):
+                    error = 'positional-only parameters are not supported'
+
+        if error:
+            raise SyntaxError(error, (
+                self.name,
+                lineno,
+                offset,
+                self._get_template_line(lineno),
+                ))
+
+        self._signature = signature
+        self._parameters = code.co_varnames[:code.co_argcount
+            + getattr(code, 'co_kwonlyargcount', 0)]
+
+    # <?_...?>
+    @decorate_attributes(pattern='^_')
+    def _handle_translation(self, chunk):
+        r"""Translate a message by gettext.
+
+        A message is translated on compiling by `translations`, an
+        expression after '=' is translated on rendering.
+
+        >>> dprint(render_string('<?_ hello, world ?>'))
+        hello, world
+        >>> dprint(render_string('<?_= name ?>', {'name': 'world',
+        ...                      '__gettext__': lambda s: s.upper()}))
+        WORLD
+        """
+        if chunk.startswith('_='):
+            self._handle_inline_expression(
+                '=__gettext__(%s)' % _strip_comments(chunk[2:]))
+            return
+
+        message = chunk[1:].strip()
+        if self.translations is not None:
+            translated = getattr(self.translations, 'ugettext',
+                                 self.translations.gettext)(message)
+            self._messages[message] = translated
+            message = translated
+        self._appendliteral(_Value(message))
+
     # <?\...?>
     @decorate_attributes(pattern='^\\\\', executable=False)
     def _handle_escape(self, chunk):
@@ -1196,10 +2627,433 @@ class Translator(object):
         >>> dprint(render_string('<?\py "hello, world"?>'))
         <?py "hello, world"?>
         """
-        self._appendline('yield ' + literalize(PREFIX + chunk[1:] + SUFFIX))
+        self._appendliteral(PREFIX + chunk[1:] + SUFFIX)
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Collect names which a statement reads and binds in its scope."""
+
+    # these see the namespace dynamically
+    dynamic_functions = frozenset(('locals', 'globals', 'vars', 'eval',
+                                   'exec', 'execfile'))
+
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.dynamic = False
+
+    def _read(self, name):
+        self.reads.add(name)
+        if name in self.dynamic_functions:
+            self.dynamic = True
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, (ast.Store, ast.Del)):
+            self.writes.add(node.id)
+        else:
+            self._read(node.id)
+
+    def visit_FunctionDef(self, node):
+        # a macro binds its name, names in its body are only read
+        self.writes.add(node.name)
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name):
+                self._read(child.id)
+
+    visit_ClassDef = visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node):
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name):
+                self._read(child.id)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self.writes.add((alias.asname or alias.name).split('.')[0])
+
+    visit_ImportFrom = visit_Import
+
+    def visit_ExceptHandler(self, node):
+        if isinstance(getattr(node, 'name', None), StringType):
+            self.writes.add(node.name)
+        self.generic_visit(node)
+
+
+class IncrementalRenderer(object):
+    """Render a template again executing only parts affected by changes.
+
+    Each statement at the top level of the template (a literal, an
+    expression, a block or a script) is a segment. A segment is executed
+    again if it reads or binds a changed name or a name which is bound by an
+    executed segment, the outputs of the other segments are reused. So the
+    segments must depend only on the names which they read.
+
+    Changes are detected against deep copies of the changed values, so
+    values mutated in place are detected too. A value which can't be
+    copied, or which doesn't compare its contents, is always treated as
+    changed, and so is a value given with `changed` until it is detected
+    again.
+
+     * `translator` -- Translator without <?args?>
+
+    >>> template = render_string('<h1><?=title?></h1><p><?=body?></p>',
+    ...                          flags=returns_renderer)
+    >>> renderer = IncrementalRenderer(template)
+    >>> print(renderer.render({'title': 'a', 'body': 'b'}))
+    <h1>a</h1><p>b</p>
+    >>> print(renderer.render_changes({'title': 'a', 'body': 'c'}))
+    [(3, 'c')]
+    """
+
+    def __init__(self, translator):
+        if translator._parameters:
+            raise ValueError('a template with <?args?> is not supported')
+        self.translator = translator
+        self.segments = self._split(translator.script)
+        self._context = None
+        self._state = None
+        self._outputs = None
+
+    def _split(self, script):
+        """Compile top level statements of __main__ to functions.
+
+         * `return` -- list of (function, reads, writes, dynamic)
+        """
+        lines = script.split('\n')
+        main = [i for i in ast.parse(script).body
+                if isinstance(i, ast.FunctionDef) and i.name == '__main__'][0]
+        starts = [min([node.lineno] + [i.lineno for i in
+                                       getattr(node, 'decorator_list', ())])
+                  for node in main.body]
+
+        segments = []
+        for index, node in enumerate(main.body):
+            collector = _NameCollector()
+            collector.visit(node)
+            start = starts[index]
+            end = starts[index + 1] - 1 if index + 1 < len(starts) \
+                  else len(lines)
+
+            # NOTE: the statement keeps its line numbers in the script, so
+            #       the source map of the translator can be used.
+            source = '\n' * (start - 3) + 'def __segment__():\n' \
+                   + TAB + ('global %s\n' % ', '.join(sorted(collector.writes))
+                            if collector.writes else 'pass\n') \
+                   + '\n'.join(lines[start - 1:end])
+            namespace = {}
+            execcode(compile(source, self.translator.name, 'exec'),
+                     namespace)
+            segments.append((namespace['__segment__'],
+                             frozenset(collector.reads),
+                             frozenset(collector.writes),
+                             collector.dynamic))
+        return segments
+
+    def render(self, context, changed=None):
+        """Render the template.
+
+         * `context` -- all variables of the template
+         * `changed` -- names changed since the last rendering. They are
+                        detected by comparing with the last context if
+                        this is None.
+         * `return` -- str
+        """
+        self._update(context, changed)
+        return StringType().join(self._outputs)
+
+    def render_changes(self, context, changed=None):
+        """Render the template and get changed segments.
+
+         * `return` -- list of (index of the segment, output)
+        """
+        previous = self._outputs
+        self._update(context, changed)
+        return [(index, output) for index, output in enumerate(self._outputs)
+                if previous is None or previous[index] != output]
+
+    def _changed_names(self, context):
+        changed = set(self._context) ^ set(context)
+        for key, value in context.items():
+            if key in self._context:
+                old = self._context[key]
+                try:
+                    if old is not value and old != value:
+                        changed.add(key)
+                except Exception:
+                    changed.add(key)
+        return changed
+
+    def _update(self, context, changed):
+        translator = self.translator
+        # names given by the caller are not compared, so not copied
+        snapshot = _snapshot if changed is None else lambda value: notgiven
+        full = self._outputs is None
+        if not full:
+            if changed is None:
+                changed = self._changed_names(context)
+            changed = set(changed)
+            # these change the output of all expressions
+            full = bool(changed & set(('__cast_string__', '__except_hook__',
+                                       '__gettext__')))
+
+        if full:
+            self._state, _ = translator._prepare_many(context)
+            outputs = [None] * len(self.segments)
+        else:
+            for key in changed:
+                if key in context:
+                    self._state[key] = context[key]
+                else:
+                    self._state.pop(key, None)
+            outputs = list(self._outputs)
+
+        # a failed rendering is done again from scratch
+        self._outputs = None
+        dirty = changed
+        for index, (function, reads, writes, dynamic) in \
+                enumerate(self.segments):
+            if full or dynamic or reads & dirty or writes & dirty:
+                outputs[index] = StringType().join(
+                    translator._exectamplate(self._state, 0, function))
+                if not full:
+                    dirty |= writes
+
+        # unchanged values keep their snapshots
+        if self._context is None or changed is None:
+            self._context = dict((key, snapshot(value))
+                                 for key, value in context.items())
+        else:
+            for key in changed:
+                if key in context:
+                    self._context[key] = snapshot(context[key])
+                else:
+                    self._context.pop(key, None)
+        self._outputs = outputs
+
+
+def _snapshot(value):
+    """Deep copy of a context value of `IncrementalRenderer`, or `notgiven`
+    which is never equal to the value."""
+    import copy
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return notgiven
+
+
+_impure_modules = frozenset(('time', 'datetime', 'random', 'uuid', 'os',
+                             'secrets'))
+_impure_functions = frozenset(('open', 'print', 'input', 'exec', 'eval'))
+_impure_methods = frozenset(('now', 'utcnow', 'today', 'time', 'monotonic',
+                             'perf_counter', 'random', 'randint', 'choice',
+                             'shuffle', 'uuid1', 'uuid4', 'urandom'))
+
+
+def find_impurities(translator):
+    """Find constructs which make the output of a template depend on other
+    than its context.
+
+     * `return` -- list of (lineno, offset, reason) in the template
+    """
+    main = [i for i in ast.parse(translator.script).body
+            if isinstance(i, ast.FunctionDef) and i.name == '__main__'][0]
+
+    result = []
+    for node in ast.walk(main):
+        reason = None
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            modules = [node.module] if isinstance(node, ast.ImportFrom) \
+                      else [i.name for i in node.names]
+            modules = [i for i in modules
+                       if i and i.split('.')[0] in _impure_modules]
+            if modules:
+                reason = 'imports %s' % ', '.join(modules)
+        elif isinstance(node, ast.Global) \
+             or type(node).__name__ == 'Nonlocal':
+            reason = 'binds outer names'
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) \
+               and node.func.id in _impure_functions:
+                reason = 'calls %s()' % node.func.id
+            elif isinstance(node.func, ast.Attribute) \
+                 and node.func.attr in _impure_methods:
+                reason = 'calls .%s()' % node.func.attr
+        elif isinstance(node, (ast.Assign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) \
+                      else [node.target]
+            if any(isinstance(i, (ast.Attribute, ast.Subscript))
+                   for i in targets):
+                reason = 'modifies an object'
+
+        if reason:
+            lineno, offset = translator._find_original_pos(node.lineno)
+            result.append((lineno, offset, reason))
+
+    return sorted(set(result))
+
+
+class MemoizedRenderer(object):
+    """Cache outputs of a pure template.
+
+    A template is pure if its output depends only on its context. The
+    context is fingerprinted by its items and the types of the values, which
+    must be hashable, or by `key`. A context which can't be fingerprinted is
+    rendered every time.
+    Impure constructs of the template are warned by RuntimeWarning, see
+    `find_impurities()`.
+
+     * `translator` -- Translator
+     * `maxsize` -- maximum number of cached outputs
+     * `ttl` -- seconds to keep an output, None is forever
+     * `key` -- function(context) -> hashable fingerprint
+
+    >>> template = render_string('<?=name?>', flags=returns_renderer)
+    >>> renderer = MemoizedRenderer(template, maxsize=10)
+    >>> print(renderer({'name': 'world'}))
+    world
+    >>> print(renderer({'name': 'world'}))
+    world
+    >>> print(renderer.hits, renderer.misses)
+    1 1
+    """
+
+    def __init__(self, translator, maxsize=128, ttl=None, key=None):
+        import collections
+        import threading
+        import warnings
+
+        self.translator = translator
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.key = key
+        self.hits = self.misses = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.impurities = find_impurities(translator)
+        for lineno, offset, reason in self.impurities:
+            warnings.warn('%s:%d:%d: the template %s, its output may not be '
+                          'cached correctly' % (translator.name, lineno,
+                                                offset, reason),
+                          RuntimeWarning, stacklevel=2)
+
+    def _fingerprint(self, context):
+        try:
+            if self.key is not None:
+                fingerprint = self.key(context)
+            else:
+                # 1, 1.0 and True are equal but rendered differently
+                fingerprint = frozenset((k, type(v), v)
+                                        for k, v in context.items())
+            return hash(fingerprint), fingerprint
+        except TypeError: # unhashable
+            return None
+
+    def __call__(self, context, flags=0):
+        """Render the template or get the cached output.
+
+        See `Translator.__call__()`. The output of returns_iter is cached
+        as a whole.
+        """
+        fingerprint = self._fingerprint(context)
+        if fingerprint is None:
+            return self.translator(dict(context), flags)
+
+        key = fingerprint[1], flags
+        now = _clock()
+        with self._lock:
+            entry = self._cache.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > now):
+                self._cache[key] = entry # most recently used
+                self.hits += 1
+                result = entry[1]
+            else:
+                result = None
+                self.misses += 1
+
+        if result is None:
+            result = self.translator(dict(context), flags & ~returns_iter)
+            expires = now + self.ttl if self.ttl is not None else None
+            with self._lock:
+                self._cache[key] = expires, result
+                while len(self._cache) > self.maxsize:
+                    self._cache.popitem(last=False)
+
+        if flags & returns_iter:
+            return iter((result, ))
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
 
 
 #
+# compression
+#
+_gzip_header = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def compress_segment(bytes, level=6):
+    """Compress bytes as a self-contained part of a deflate stream.
+
+     * `return` -- (bytes, compressed bytes) for `gzip_iter()`
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return bytes, compressor.compress(bytes) \
+                  + compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+def gzip_iter(chunks, level=6, encoding='utf-8', segments=None,
+              flush_size=1024 * 16):
+    r"""Compress chunks into a gzip stream incrementally.
+
+     * `chunks` -- iterable of str or bytes, str is encoded by `encoding`
+     * `level` -- compression level
+     * `segments` -- dict {chunk: compress_segment(chunk)}. These chunks are
+                     copied into the stream without compression.
+     * `flush_size` -- the compressor is flushed after this size of input
+                       so that the stream can be sent progressively.
+
+    >>> import gzip
+    >>> data = b''.join(gzip_iter(['hello, ', b'world']))
+    >>> print(gzip.GzipFile(fileobj=io.BytesIO(data)).read().decode('utf-8'))
+    hello, world
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = size = unflushed = 0
+
+    yield _gzip_header
+
+    for chunk in chunks:
+        segment = segments.get(chunk) if segments else None
+
+        if segment is not None:
+            # NOTE: Z_FULL_FLUSH resets the history, the compressed segment
+            #       and the following data don't refer the previous data.
+            chunk, compressed = segment
+            result = compressor.flush(zlib.Z_FULL_FLUSH) + compressed
+            unflushed = 0
+
+        else:
+            if isinstance(chunk, StringType):
+                chunk = chunk.encode(encoding)
+            result = compressor.compress(chunk)
+            unflushed += len(chunk)
+            if flush_size is not None and unflushed >= flush_size:
+                result += compressor.flush(zlib.Z_SYNC_FLUSH)
+                unflushed = 0
+
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        if result:
+            yield result
+
+    yield compressor.flush(zlib.Z_FINISH) \
+          + struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)
+
+
+#
 # module globals
 #
 default_translator = Translator
@@ -1300,13 +3154,93 @@ def render_string(string_or_bytes, context={}, flags=0):
     return template(dict(default_context, **context), flags)
 
 
+# {(package, resource_name): (version, translator)} in LRU order
+_resource_cache = {}
+_resource_cache_size = 256
+
+
+def _resource_mtime(module, resource_name):
+    """The mtime of a resource in a package directory, or None."""
+    try:
+        path = os.path.join(os.path.dirname(module.__file__),
+                            *resource_name.split('/'))
+        return os.stat(path).st_mtime
+    except (AttributeError, TypeError, OSError): # e.g. zipped
+        return None
+
+
+def _load_resource(package_or_requirement, resource_name):
+    """Compile a package resource, cached by the package version or the
+    resource mtime."""
+    if isinstance(package_or_requirement, (StringType, types.ModuleType)):
+        import importlib
+        module = package_or_requirement
+        if isinstance(module, StringType):
+            module = importlib.import_module(module)
+        key = module.__name__, resource_name
+        version = getattr(module, '__version__', None)
+        if version is None:
+            version = _resource_mtime(module, resource_name)
+    else:
+        # pkg_resources.Requirement
+        module = None
+        key = str(package_or_requirement), resource_name
+        version = None
+
+    # popped and inserted again as the most recently used
+    cached = _resource_cache.pop(key, None)
+    if cached is not None and cached[0] == version:
+        _resource_cache[key] = cached
+        return cached[1]
+
+    try:
+        from importlib.resources import files
+    except ImportError: # Python < 3.9
+        files = None
+
+    if files is not None and module is not None:
+        # a resource of a plain module is next to it, as pkg_resources does
+        anchor = module
+        if not hasattr(module, '__path__'):
+            import importlib
+            parent = getattr(getattr(module, '__spec__', None), 'parent',
+                             None)
+            anchor = importlib.import_module(parent) if parent else None
+
+        if anchor is not None:
+            # NOTE: Traversable supports zipimport and wheels.
+            path = files(anchor)
+            for part in resource_name.split('/'):
+                path = path.joinpath(part)
+            fp = path.open('rb')
+        else:
+            fp = open(os.path.join(os.path.dirname(module.__file__),
+                                   *resource_name.split('/')), 'rb')
+    else:
+        import pkg_resources
+        fp = pkg_resources.resource_stream(package_or_requirement,
+                                           resource_name)
+
+    with fp:
+        result = default_translator(fp)
+    _resource_cache[key] = version, result
+    while len(_resource_cache) > _resource_cache_size:
+        try:
+            del _resource_cache[next(iter(_resource_cache))]
+        except (KeyError, RuntimeError, StopIteration): # another thread
+            break
+    return result
+
+
 def render_resource(package_or_requirement, resource_name, context={}, flags=0):
-    r"""Render a package resource via `pkg_resources.resource_stream()`.
-    """
-    import pkg_resources
+    r"""Render a package resource.
 
-    template = default_translator(
-        pkg_resources.resource_stream(package_or_requirement, resource_name))
+    The resource is read by `importlib.resources` and compiled once for
+    each version (`__version__`) of the package, or for each mtime of the
+    resource if the package has no version. `pkg_resources` is used for a
+    requirement or on Python < 3.9.
+    """
+    template = _load_resource(package_or_requirement, resource_name)
 
     if flags & returns_renderer:
         assert not context
@@ -1315,46 +3249,607 @@ def render_resource(package_or_requirement, resource_name, context={}, flags=0):
     return template(dict(default_context, **context), flags)
 
 
-# TODO: webob.dec.wsgify(TemplateApp(filename, **response_kwargs))
+def iter_template_files(path, suffix='.html'):
+    """Iterate template filenames under a directory recursively."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(suffix):
+                yield os.path.join(root, name)
+
 
+def format_template_error(filename, error):
+    """Format a template error as `filename:lineno:offset: message`."""
+    if isinstance(error, SyntaxError):
+        return '%s:%s:%s: %s: %s' % (
+            error.filename or filename, error.lineno, error.offset,
+            type(error).__name__, error.msg)
+    return '%s: %s: %s' % (filename, type(error).__name__, error)
 
-class KatagamiTemplate(object):
+
+_render_worker = None
+
+
+def _init_render_worker(translator, base, flags):
+    global _render_worker
+    _render_worker = translator, flags, translator._prepare_many(base)
+
+
+def _render_batch(contexts):
+    """Render contexts in a worker process of `Translator.render_many()`."""
+    translator, flags, (namespace, function) = _render_worker
+    return [translator._render(dict(namespace, **context), flags, function)
+            for context in contexts]
+
+
+def _render_parallel(translator, contexts, flags, base, workers, ordered,
+                     chunksize):
+    import concurrent.futures
+
+    contexts = iter(contexts)
+    with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_render_worker,
+            initargs=(translator, base,
+                      flags & ~returns_iter)) as executor:
+        pending = {} # future: index of the first context
+        start = 0
+        while 1:
+            # keep the workers busy without reading all contexts at once
+            while len(pending) < workers * 2:
+                batch = list(itertools.islice(contexts, chunksize))
+                if not batch:
+                    break
+                pending[executor.submit(_render_batch, batch)] = start
+                start += len(batch)
+
+            if not pending:
+                break
+            elif ordered:
+                done = [min(pending, key=pending.get)]
+            else:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done:
+                index = pending.pop(future)
+                for result in future.result():
+                    yield result if ordered else (index, result)
+                    index += 1
+
+
+def _compile_template_file(filename, catalog=None, body=None):
+    """Compile a template file in a worker process.
+
+     * `catalog` -- arguments of `_load_translations()`, the catalog is
+                    loaded in the worker
+     * `body` -- bytes of the file, which is not read from `filename` then,
+                 e.g. a member of ArchiveLoader. The mtime is None.
+     * `return` -- (mtime, translator, None) or (None, None, error)
+    """
+    try:
+        if body is None:
+            mtime = os.stat(filename).st_mtime
+            fp = open(filename, 'rb')
+        else:
+            mtime = None
+            fp = io.BytesIO(body)
+            fp.name = filename
+        translations = None if catalog is None \
+                       else _load_translations(*catalog)
+        with fp:
+            return mtime, Translator(fp, translations), None
+    except Exception as e:
+        return None, None, e
+
+
+def _compile_in_workers(jobs, workers):
+    """Call `_compile_template_file(*job)` for each job, in `workers`
+    processes if it is more than 1.
+
+     * `return` -- list of the results
+    """
+    if workers is None:
+        workers = os.cpu_count() if hasattr(os, 'cpu_count') else 1
+
+    if workers > 1 and len(jobs) > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(_compile_template_file, *i)
+                       for i in jobs]
+            compiled = []
+            for future in futures:
+                # e.g. an unpicklable result or a broken pool
+                try:
+                    compiled.append(future.result())
+                except Exception as e:
+                    compiled.append((None, None, e))
+        return compiled
+    return [_compile_template_file(*i) for i in jobs]
+
+
+def warm_up(paths, workers=None, suffix='.html'):
+    r"""Compile templates in parallel.
+
+     * `paths` -- filenames or directories. Directories are searched
+                  recursively for files which end with `suffix`.
+     * `workers` -- number of worker processes. `None` means the number of
+                    CPUs, 0 or 1 compiles in this process.
+     * `return` -- dict {filename: (mtime, Translator or exception)}
+
+    A broken template doesn't abort the others, its error is returned
+    instead of a Translator.
+    """
+    if isinstance(paths, StringType):
+        paths = [paths]
+
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(iter_template_files(path, suffix))
+        else:
+            filenames.append(path)
+
+    compiled = _compile_in_workers([(i, ) for i in filenames], workers)
+
+    result = {}
+    for filename, (mtime, translator, error) in zip(filenames, compiled):
+        if error is None:
+            result[filename] = mtime, translator
+        else:
+            result[filename] = mtime, error
+
+    return result
+
+
+class _ResponseBody(object):
+    """WSGI response iterable, `close()` finalizes the rendering."""
+
+    def __init__(self, chunks, close):
+        self._chunks = chunks
+        self.close = close
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+def _accepts_encoding(header, coding):
+    """Whether Accept-Encoding `header` accepts `coding` by its q-value."""
+    qvalues = {}
+    for item in header.split(','):
+        params = item.split(';')
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[params[0].strip().lower()] = q
+    return qvalues.get(coding, qvalues.get('*', 0)) > 0
+
+
+class TemplateApp(object):
+    """WSGI application serving a template.
+
+     * `template` -- Translator or filename
+     * `context` -- variables for template execution context. The WSGI
+                    environ is added as `environ` on each request.
+     * `status` -- response status
+     * `content_type` -- the charset is taken from the template encoding
+     * `headers` -- additional response headers
+     * `buffered` -- render the whole body before starting the response and
+                     set Content-Length, otherwise the body is streamed.
+     * `gzip` -- compress the body if the client accepts gzip
+     * `gzip_level` -- compression level, `gzip_level` of the template by
+                       default
+
+    >>> from wsgiref.util import setup_testing_defaults
+    >>> app = TemplateApp(render_string('<?=environ["PATH_INFO"]?>',
+    ...                                 flags=returns_renderer),
+    ...                   buffered=True)
+    >>> environ = {'PATH_INFO': '/hello'}
+    >>> setup_testing_defaults(environ)
+    >>> body = app(environ, lambda status, headers: dprint(headers))
+    [('Content-Type', 'text/html; charset=utf-8'), ('Content-Length', '6')]
+    >>> dprint(b''.join(body).decode('utf-8'))
+    /hello
+    """
+
+    def __init__(self, template, context={}, status='200 OK',
+                 content_type='text/html', headers=(), buffered=False,
+                 gzip=False, gzip_level=None):
+        if isinstance(template, StringType):
+            with open(template, 'rb') as fp:
+                template = default_translator(fp)
+        self.template = template
+        self.context = context
+        self.status = status
+        self.content_type = content_type
+        self.headers = list(headers)
+        self.buffered = buffered
+        self.gzip = gzip
+        self.gzip_level = gzip_level
+
+    def __call__(self, environ, start_response):
+        template = self.template
+        headers = [('Content-Type', '%s; charset=%s' % (
+            self.content_type, template.encoding))]
+        headers.extend(self.headers)
+
+        compress = self.gzip and _accepts_encoding(
+            environ.get('HTTP_ACCEPT_ENCODING', ''), 'gzip')
+        if self.gzip:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+
+        context = dict(default_context, **self.context)
+        context['environ'] = environ
+        # gzip_iter() encodes str chunks to look up precompressed segments
+        rendering = template(context, returns_iter if compress
+                                      else returns_iter | returns_bytes)
+
+        # run the template up to the first chunk, so that an error at the
+        # beginning is raised before start_response()
+        first = next(rendering, None)
+        chunks = rendering if first is None \
+                 else itertools.chain((first, ), rendering)
+        if compress:
+            level = template.gzip_level if self.gzip_level is None \
+                    else self.gzip_level
+            chunks = gzip_iter(chunks, level, template.encoding,
+                               template._get_gzip_segments(level))
+
+        if self.buffered:
+            body = BytesType().join(chunks)
+            headers.append(('Content-Length', str(len(body))))
+            start_response(self.status, headers)
+            return [body]
+
+        start_response(self.status, headers)
+        return _ResponseBody(chunks, rendering.close)
+
+
+class _MappedFile(object):
+    """File interface of mmap for zipfile."""
+
+    def __init__(self, map):
+        self._map = map
+
+    def seekable(self):
+        return True
+
+    def __getattr__(self, name):
+        return getattr(self._map, name)
+
+
+class ArchiveLoader(object):
+    """Load templates from a zip archive for `KatagamiTemplate`.
+
+    The archive is opened once and mapped into memory, the directory of the
+    archive is read on opening and each template is decompressed when it is
+    compiled. The archive can be replaced atomically (rename over), it is
+    opened again when its inode, size or mtime changes, and each opening
+    is a new generation which invalidates the templates compiled before.
+
+     * `filename` -- zip archive
+     * `check_interval` -- seconds between checks of the archive
+    """
+
+    def __init__(self, filename, check_interval=1.0):
+        self.filename = filename
+        self.check_interval = check_interval
+        self._archive = None
+        self._stat = None
+        self._checked = None
+        self._generation = 0
+
+    def _get_archive(self):
+        now = _clock()
+        if self._checked is None or self._checked + self.check_interval < now:
+            stat = os.stat(self.filename)
+            stat = stat.st_ino, stat.st_size, \
+                   getattr(stat, 'st_mtime_ns', stat.st_mtime)
+            if stat != self._stat:
+                import mmap
+                import zipfile
+                with open(self.filename, 'rb') as fp:
+                    map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                # NOTE: the previous archive is not closed, it may be read
+                #       by another thread.
+                self._archive = zipfile.ZipFile(_MappedFile(map))
+                self._stat = stat
+                self._generation += 1
+            self._checked = now
+        return self._archive
+
+    def names(self):
+        """Names of all files in the archive."""
+        return [i.filename for i in self._get_archive().infolist()
+                if not i.filename.endswith('/')]
+
+    def stat(self, name):
+        """The version of a file, which is the generation of the archive.
+        It is compared as the mtime of a file.
+
+        OSError is raised if the file is not in the archive.
+        """
+        archive = self._get_archive()
+        if name not in archive.NameToInfo:
+            raise OSError(errno.ENOENT, 'template is not found',
+                          os.path.join(self.filename, name))
+        return self._generation
+
+    def open(self, name):
+        """Open a file in the archive as binary."""
+        fp = self._get_archive().open(name)
+        fp.name = os.path.join(self.filename, name)
+        return fp
+
+
+class KatagamiTemplate(object):
+    # the least recently used template names are forgotten over this
+    max_resolved = 1024
 
     def __init__(self, path=None, suffix='.html', flags=0,
                  default_context=default_context, cache=None,
-                 update_on_modified=True):
+                 update_on_modified=True, compact=False, domain=None,
+                 localedir=None, resolve_ttl=0, missing_ttl=0,
+                 loader=None):
+        """
+         * `path` -- directory or list of directories searched in order
+         * `loader` -- ArchiveLoader, templates are loaded from this instead
+                       of `path`
+         * `domain`, `localedir` -- gettext catalog of <?_message?>. A
+                                    template is compiled for each `locale`
+                                    argument of rendering.
+         * `resolve_ttl` -- seconds to remember the file of a template and
+                            its mtime, 0 stats on each rendering
+         * `missing_ttl` -- seconds to remember a missing template
+        """
+        import collections
+
         assert not (flags & returns_renderer)
         self.path = path
+        self.paths = [path] if isinstance(path, StringType) \
+                     else list(path or ())
         self.suffix = suffix
         self.flags = flags
         self.default_context = default_context
         self.cache = cache
         self.update_on_modified = update_on_modified
+        self.compact = compact
+        self.domain = domain
+        self.localedir = localedir
+        self.resolve_ttl = resolve_ttl
+        self.missing_ttl = missing_ttl
+        self.loader = loader
+        self._translations = {}
+        self._resolved = collections.OrderedDict()
+        self._loading = {}
 
     def _get_template_filename(self, template_name):
-        return os.path.join(self.path, template_name + self.suffix)
+        return self._resolve(template_name)[0]
+
+    def _resolve(self, template_name):
+        """Search a template in `paths`.
+
+         * `return` -- (filename, mtime)
+        """
+        if self.loader is not None:
+            filename = template_name + self.suffix
+            return filename, self.loader.stat(filename)
+
+        now = _clock()
+        # popped and inserted again as the most recently used
+        resolved = self._resolved.pop(template_name, None)
+        if resolved is None or resolved[0] < now:
+            filename = mtime = None
+            for path in self.paths:
+                candidate = os.path.join(path, template_name + self.suffix)
+                try:
+                    mtime = os.stat(candidate).st_mtime
+                except OSError:
+                    continue
+                filename = candidate
+                break
 
-    def _create_template(self, template_name):
+            ttl = self.missing_ttl if filename is None else self.resolve_ttl
+            resolved = now + ttl, filename, mtime
+
+        if resolved[0] > now:
+            self._resolved[template_name] = resolved
+            while len(self._resolved) > self.max_resolved:
+                try:
+                    self._resolved.popitem(last=False)
+                except KeyError: # emptied by another thread
+                    break
+
+        filename, mtime = resolved[1:]
+        if filename is None:
+            raise OSError(errno.ENOENT, 'template is not found',
+                          template_name)
+        return filename, mtime
+
+    def _open(self, filename):
+        if self.loader is not None:
+            return self.loader.open(filename)
+        return open(filename, 'rb')
+
+    def _get_translations(self, locale):
+        if locale not in self._translations:
+            self._translations[locale] = _load_translations(
+                self.domain, self.localedir,
+                [locale] if locale else None)
+        return self._translations[locale]
+
+    def _create_template(self, template_name, locale=None):
         import katagami
 
-        filename = self._get_template_filename(template_name)
-        mtime = os.stat(filename).st_mtime \
-                if self.update_on_modified else -1
+        filename, mtime = self._resolve(template_name)
+        if not self.update_on_modified:
+            mtime = -1
 
-        if self.cache is not None and template_name in self.cache \
-           and self.cache[template_name].mtime >= mtime:
-            result = self.cache[template_name]
+        # a translated variant is cached for each locale
+        key = template_name if self.domain is None \
+              else (template_name, locale)
+
+        if self.cache is not None and key in self.cache \
+           and self.cache[key].mtime >= mtime:
+            result = self.cache[key]
 
         else:
-            with open(filename, 'rb') as fp:
-                result = katagami.Translator(fp)
+            with self._open(filename) as fp:
+                if self.domain is None:
+                    result = katagami.Translator(fp)
+                else:
+                    result = katagami.Translator(
+                        fp, self._get_translations(locale))
 
             if self.cache is not None:
                 result.mtime = mtime
-                self.cache[template_name] = result
+                if self.compact:
+                    result.compact()
+                self.cache[key] = result
 
         return result
 
+    def _get_cached_template(self, template_name, locale=None):
+        """A template in `cache` which is known to be fresh without I/O, or
+        None."""
+        key = template_name if self.domain is None \
+              else (template_name, locale)
+        if self.cache is None or key not in self.cache:
+            return None
+        result = self.cache[key]
+        if not self.update_on_modified:
+            return result
+        resolved = self._resolved.get(template_name)
+        if self.loader is None and resolved is not None \
+           and resolved[0] >= _clock() and resolved[1] is not None \
+           and result.mtime >= resolved[2]:
+            return result
+        return None
+
+    def load_async(self, template_name, locale=None, executor=None):
+        """Load a template for asyncio without blocking the event loop.
+
+        The stat, the read and the compile are done in `executor`. A
+        template in `cache` which is fresh within `resolve_ttl` is returned
+        without leaving the loop, and concurrent loads of the same template
+        share one compile. This is called in the running event loop.
+
+         * `executor` -- concurrent.futures.Executor, the default executor
+                         of the loop if None
+         * `return` -- awaitable of Translator
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+
+        result = self._get_cached_template(template_name, locale)
+        if result is not None:
+            future = loop.create_future()
+            future.set_result(result)
+            return future
+
+        key = loop, template_name, locale if self.domain else None
+        future = self._loading.get(key)
+        if future is None:
+            future = self._loading[key] = loop.run_in_executor(
+                executor, self._create_template, template_name, locale)
+            future.add_done_callback(lambda _: self._loading.pop(key, None))
+        # a cancelled caller does not cancel the others
+        return asyncio.shield(future)
+
+    def warm_up(self, workers=None, locales=(None, )):
+        """Compile all templates under `paths` or of `loader` into `cache`
+        in parallel.
+
+        Members of `loader` are read in this process and compiled in the
+        workers, catalogs of `domain` are loaded in each worker.
+
+         * `workers` -- number of worker processes, see `warm_up()`.
+         * `locales` -- locales compiled for each template if `domain` is set
+         * `return` -- dict {cache key: exception} of broken templates
+        """
+        assert self.cache is not None
+
+        template_names = {}
+        if self.loader is not None:
+            for filename in self.loader.names():
+                if filename.endswith(self.suffix):
+                    template_names[self._strip_suffix(filename)] = filename
+        else:
+            # the first directory wins, overridden templates are not compiled
+            for path in reversed(self.paths):
+                for filename in iter_template_files(path, self.suffix):
+                    template_name = self._strip_suffix(
+                        os.path.relpath(filename, path)).replace(os.sep, '/')
+                    template_names[template_name] = filename
+        if self.domain is None:
+            locales = (None, )
+
+        errors = {}
+        keys, mtimes, jobs = [], [], []
+        for template_name, filename in sorted(template_names.items()):
+            body = mtime = None
+            if self.loader is not None:
+                try:
+                    mtime = self.loader.stat(filename)
+                    with self.loader.open(filename) as fp:
+                        body = fp.read()
+                except Exception as e:
+                    logger.error('%s', format_template_error(filename, e))
+                    for locale in locales:
+                        errors[template_name if self.domain is None
+                               else (template_name, locale)] = e
+                    continue
+            for locale in locales:
+                if self.domain is None:
+                    keys.append(template_name)
+                    catalog = None
+                else:
+                    keys.append((template_name, locale))
+                    catalog = (self.domain, self.localedir,
+                               [locale] if locale else None)
+                mtimes.append(mtime)
+                jobs.append((filename, catalog, body))
+
+        for key, mtime, job, (worker_mtime, result, error) in zip(
+                keys, mtimes, jobs, _compile_in_workers(jobs, workers)):
+            if error is not None:
+                logger.error('%s', format_template_error(job[0], error))
+                errors[key] = error
+                continue
+
+            if mtime is None:
+                mtime = worker_mtime
+            result.mtime = mtime if self.update_on_modified else -1
+            if self.domain is not None:
+                # share the catalog with templates compiled on demand
+                result.translations = self._get_translations(key[1])
+            if self.compact:
+                result.compact()
+            self.cache[key] = result
+
+        return errors
+
+    def _strip_suffix(self, filename):
+        suffix = self.suffix
+        if suffix and filename.endswith(suffix):
+            return filename[:-len(suffix)]
+        return filename
+
+    def memory_report(self):
+        """Bytes used by each cached template, see `Translator.memory_usage()`.
+
+         * `return` -- dict {template_name: bytes}
+        """
+        assert self.cache is not None
+        return dict((template_name, translator.memory_usage())
+                    for template_name, translator in self.cache.items())
+
     def __call__(self, template_name, kwargs):
         """Template contract is any callable of the following form:
 
@@ -1364,7 +3859,8 @@ def render_resource(package_or_requirement, resource_name, context={}, flags=0):
         https://pythonhosted.org/wheezy.web/userguide.html#contract
         """
 
-        template = self._create_template(template_name)
+        template = self._create_template(template_name,
+                                         kwargs.get('locale'))
 
         context = {}
         context.update(self.default_context)
@@ -1415,6 +3911,1057 @@ class Test(unittest.TestCase):
         self.assertEqual(cx.exception.lineno, 11)
         self.assertEqual(cx.exception.offset, 3)
 
+    def test_streaming_compile(self):
+        template = 'ab<?=x?>cd\n' * 50 + '<?py\n y = "Y" ?>' + 'e' * 100 \
+                 + '<?=y?>\r\n<?}<'
+        expected = template.replace('<?=x?>', 'X') \
+                           .replace('<?py\n y = "Y" ?>', '') \
+                           .replace('<?=y?>', 'Y')
+
+        class SmallTranslator(Translator):
+            read_size = 7
+            max_source_size = 100
+
+        # the source of a file is read again when it's needed
+        import tempfile
+        fd, filename = tempfile.mkstemp(suffix='.html')
+        try:
+            with io.open(fd, 'w', newline='') as file:
+                file.write(template)
+            with open(filename, 'rb') as file:
+                translator = SmallTranslator(file)
+            self.assertIsNone(translator._template_body)
+            self.assertEqual(translator({'x': 'X'}), expected)
+            self.assertEqual(translator._get_template_line(2),
+                             'ab<?=x?>cd')
+        finally:
+            os.remove(filename)
+
+        # the source which is not a file is kept whole
+        file = io.StringIO(template)
+        file.name = 'streaming.html'
+        translator = SmallTranslator(file)
+        self.assertEqual(translator._template_body, template)
+
+        # an anonymous template can't be read again
+        translator = SmallTranslator(io.StringIO(template))
+        self.assertEqual(translator._template_body, template)
+
+        translator = Translator(io.StringIO(template))
+        self.assertEqual(translator._template_body, template)
+        self.assertEqual(translator({'x': 'X'}), expected)
+
+    def test_warm_up(self):
+        import tempfile
+        import shutil
+
+        path = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(path, 'sub'))
+            for name, body in (('index.html', 'hello, <?=name?>'),
+                               ('sub/page.html', '<p><?=name?></p>'),
+                               ('broken.html', '\n  <?py syntax error ?>'),
+                               ('ignored.txt', '<?py syntax error ?>')):
+                with open(os.path.join(path, name), 'w') as fp:
+                    fp.write(body)
+
+            templates = KatagamiTemplate(path, cache={})
+            errors = templates.warm_up(workers=2)
+            self.assertEqual(sorted(templates.cache), ['index', 'sub/page'])
+            self.assertEqual(sorted(errors), ['broken'])
+            self.assertEqual(errors['broken'].lineno, 2)
+            self.assertEqual(errors['broken'].offset, 2)
+            self.assertEqual(templates('sub/page', {'name': 'world'}),
+                             '<p>world</p>')
+
+            # an empty suffix matches whole filenames
+            templates = KatagamiTemplate(path, suffix='', cache={})
+            errors = templates.warm_up(workers=1)
+            self.assertEqual(sorted(templates.cache),
+                             ['index.html', 'sub/page.html'])
+            self.assertEqual(sorted(errors), ['broken.html', 'ignored.txt'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_template_name(self):
+        a = render_string('<?=a?>', flags=returns_renderer)
+        b = render_string('<?=b?>', flags=returns_renderer)
+        self.assertNotEqual(a.name, b.name)
+        self.assertEqual(
+            a.name, render_string(b'<?=a?>', flags=returns_renderer).name)
+        self.assertEqual(linecache.getline(a.name, 1), '<?=a?>')
+
+        # removed from linecache with the last translator
+        import gc
+        c = render_string('<?=c?>', flags=returns_renderer)
+        name = c.name
+        d = render_string('<?=c?>', flags=returns_renderer)
+        del c
+        gc.collect()
+        self.assertEqual(linecache.getline(name, 1), '<?=c?>')
+        del d
+        gc.collect()
+        self.assertNotIn(name, linecache.cache)
+
+    def test_embed_script_reindent(self):
+        template = '''<?py
+            value = (1 +
+          2)
+            text = """
+  keep "this" indent
+"""
+        ?><? if value == 3: {?><?py result = \\
+    text ?><?=result?><?}?>'''
+        self.assertEqual(render_string(template), '\n  keep "this" indent\n')
+
+        translator = render_string(template, flags=returns_renderer)
+        self.assertIn(TAB + 'value = (1 +\n          2)\n', translator.script)
+
+        # each line of a script is marked once
+        translator = render_string('a<?py\nx = 1\n?><?=str(x)?>',
+                                   flags=returns_renderer)
+        self.assertEqual(
+            [i.strip() for i in translator.script.splitlines()
+             if '-*- line' in i],
+            ['# -*- line 2, column 0 -*-', '# -*- line 3, column 2 -*-'])
+
+    def test_trim_blocks(self):
+        template = '''<?py from katagami import trim_blocks ?>
+<ul>
+  <? for i in items: {?> <?py j = i * 2 ?>
+    <li><?=str(j)?></li>
+    <? if 0: {?>  <?}?>
+  <?}?>
+</ul>
+  <? if 1: {?>'''
+        self.assertEqual(
+            render_string(template + '<?}?>', {'items': [1, 2]}),
+            '<ul>\n    <li>2</li>\n    <li>4</li>\n</ul>\n')
+        self.assertEqual(
+            render_string(template + 'end\n  <?}?>\n  ', {'items': []}),
+            '<ul>\n</ul>\n  end\n  ')
+
+    def test_minify_html(self):
+        template = '''<?py from katagami import minify_html ?>
+<ul>   <!-- items -->
+    <? for i in items: {?>
+    <li title="<?=i?>  x">  <?=i?>  </li>
+    <?}?>
+</ul>
+<pre>  <?=items[0]?>
+  </pre>'''
+        self.assertEqual(render_string(template, {'items': ['a', 'b']}),
+                         '\n<ul> \n\n<li title="a  x"> a </li>\n'
+                         '\n<li title="b  x"> b </li>\n\n</ul>\n'
+                         '<pre>  a\n  </pre>')
+
+        template = template.replace('minify_html', 'minify_html, trim_blocks')
+        self.assertEqual(render_string(template, {'items': ['a', 'b']}),
+                         '<ul> \n <li title="a  x"> a </li>\n'
+                         ' <li title="b  x"> b </li>\n</ul>\n'
+                         '<pre>  a\n  </pre>')
+
+        # quoted values split by a PI are kept
+        self.assertEqual(render_string(
+            '<?py from katagami import minify_html ?>'
+            '<input value="<?=v?>   two  spaces">  x', {'v': 'x'}),
+            '<input value="x   two  spaces"> x')
+
+        # outputs of PIs are not minified and don't change the state
+        self.assertEqual(render_string(
+            '<?py from katagami import minify_html ?>'
+            '<p>  <?="a     b<!-- c -->"?>  <?_two  spaces?><?="<pre>"?>'
+            '  x  </p>'),
+            '<p> a     b<!-- c --> two  spaces<pre> x </p>')
+
+    def test_returns_gzip(self):
+        import gzip
+
+        template = '<html>' + 'x' * 5000 + '<?=a?>' + 'hello, <?=b?>'
+        translator = render_string(template, flags=returns_renderer)
+        expected = translator({'a': 'A', 'b': 'B'})
+
+        for flags in (returns_gzip, returns_gzip | returns_iter):
+            result = translator({'a': 'A', 'b': 'B'}, flags)
+            if flags & returns_iter:
+                result = list(result)
+                self.assertGreater(len(result), 2)
+                result = b''.join(result)
+            self.assertEqual(
+                gzip.GzipFile(fileobj=io.BytesIO(result)).read().decode(),
+                expected)
+
+        self.assertEqual(list(translator._get_gzip_segments(6)),
+                         ['<html>' + 'x' * 5000])
+
+        # the level is given for each rendering
+        for level in (0, 9):
+            result = translator({'a': 'A', 'b': 'B'}, returns_gzip,
+                                gzip_level=level)
+            self.assertEqual(
+                gzip.GzipFile(fileobj=io.BytesIO(result)).read().decode(),
+                expected)
+            self.assertIn(level, translator._gzip_segments)
+        sink = bytearray()
+        translator.render_to(sink, {'a': 'A', 'b': 'B'}, returns_gzip,
+                             gzip_level=0)
+        self.assertGreater(len(sink), 5000)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=io.BytesIO(bytes(sink))).read().decode(),
+            expected)
+
+    def test_template_app(self):
+        import gzip
+        from wsgiref.util import setup_testing_defaults
+
+        closed = []
+        translator = render_string(
+            '<? try: {?><? for i in items: {?><?=str(i)?>,<?}?>'
+            '<?} finally: {?><?py closed.append(True) ?><?}?>',
+            flags=returns_renderer)
+
+        responses = []
+        def start_response(status, headers):
+            responses.append((status, dict(headers)))
+
+        environ = {'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}
+        setup_testing_defaults(environ)
+
+        # streaming, closed by the server before the end
+        app = TemplateApp(translator, {'items': range(3), 'closed': closed})
+        body = app(environ, start_response)
+        self.assertEqual(responses[-1][0], '200 OK')
+        self.assertEqual(responses[-1][1]['Content-Type'],
+                         'text/html; charset=utf-8')
+        self.assertNotIn('Content-Length', responses[-1][1])
+        self.assertEqual(next(iter(body)), b'0')
+        self.assertEqual(closed, [])
+        body.close()
+        self.assertEqual(closed, [True])
+
+        # buffered
+        app = TemplateApp(translator, {'items': range(3), 'closed': closed},
+                          buffered=True)
+        self.assertEqual(b''.join(app(environ, start_response)), b'0,1,2,')
+        self.assertEqual(responses[-1][1]['Content-Length'], '6')
+
+        # gzip is not compressed unless it is accepted
+        for accepted in ('gzip;q=0, deflate', 'deflate', '*;q=0'):
+            environ['HTTP_ACCEPT_ENCODING'] = accepted
+            app = TemplateApp(translator, {'items': range(3), 'closed': []},
+                              gzip=True)
+            self.assertEqual(b''.join(app(environ, start_response)),
+                             b'0,1,2,')
+            self.assertNotIn('Content-Encoding', responses[-1][1])
+        environ['HTTP_ACCEPT_ENCODING'] = 'deflate, GZIP;q=0.5'
+
+        # gzip
+        app = TemplateApp(translator, {'items': range(3), 'closed': closed},
+                          gzip=True)
+        body = b''.join(app(environ, start_response))
+        self.assertEqual(responses[-1][1]['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(),
+                         b'0,1,2,')
+        app = TemplateApp(translator, {'items': range(3), 'closed': closed},
+                          gzip=True, gzip_level=0)
+        body = b''.join(app(environ, start_response))
+        self.assertIn(b'0,1,2,', body)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(body)).read(),
+                         b'0,1,2,')
+
+        # an error in the first chunk is raised before start_response()
+        app = TemplateApp(render_string('<?=1?>', flags=returns_renderer))
+        del responses[:]
+        self.assertRaises(TypeError, app, environ, start_response)
+        self.assertEqual(responses, [])
+
+    def test_render_many(self):
+        template = render_string(
+            '<?py from katagami import cast_string ?><?=prefix?><?=i?>',
+            flags=returns_renderer)
+        contexts = [{'i': i} for i in range(200)]
+        expected = [template(dict(c, prefix='#')) for c in contexts]
+
+        self.assertEqual(
+            list(template.render_many(contexts, base={'prefix': '#'})),
+            expected)
+        self.assertEqual(
+            [b''.join(i) for i in template.render_many(
+                contexts, returns_bytes | returns_iter, {'prefix': '#'})],
+            [i.encode() for i in expected])
+
+        # parallel
+        self.assertEqual(
+            list(template.render_many(contexts, base={'prefix': '#'},
+                                      workers=2, chunksize=16)),
+            expected)
+        results = list(template.render_many(
+            contexts, base={'prefix': '#'}, workers=2, ordered=False,
+            chunksize=16))
+        self.assertEqual(sorted(results), sorted(enumerate(expected)))
+
+    def test_pickle(self):
+        import pickle
+
+        translator = render_string('<?py\nx = 1\n?><?=a?>',
+                                   flags=returns_renderer)
+        translator.mtime = 10
+        translator({'a': 'A'}, returns_gzip)
+        data = pickle.dumps(translator, pickle.HIGHEST_PROTOCOL)
+
+        loaded = pickle.loads(data)
+        self.assertEqual(loaded({'a': 'A'}), 'A')
+        self.assertEqual(loaded.code, translator.code)
+        self.assertEqual(loaded.mtime, 10)
+        self.assertEqual(loaded._source_map, translator._source_map)
+        self.assertFalse(hasattr(loaded, '_gzip_segments'))
+
+        # a pickle of another version is compiled again
+        state = translator.__getstate__()
+        state['_pickle_tag'] = ('0.0.0', b'')
+        state['code'] = b'broken'
+        loaded = Translator.__new__(Translator)
+        loaded.__setstate__(state)
+        self.assertEqual(loaded({'a': 'A'}), 'A')
+        self.assertEqual(loaded.name, translator.name)
+        self.assertEqual(loaded.mtime, 10)
+        self.assertRaises(TypeError, loaded, {'a': 1})
+
+    def test_render_to(self):
+        import gzip
+        import socket
+
+        template = render_string('<? for i in range(100): {?>'
+                                 '\u00e9<?=str(i)?>,<?}?>',
+                                 flags=returns_renderer)
+        expected = template({})
+
+        sink = io.StringIO()
+        self.assertEqual(template.render_to(sink, {}), len(expected))
+        self.assertEqual(sink.getvalue(), expected)
+
+        for buffer_size in (0, 10, None, 1024 * 1024):
+            sink = io.BytesIO()
+            size = template.render_to(sink, {}, buffer_size=buffer_size)
+            self.assertEqual(sink.getvalue(), expected.encode('utf-8'))
+            self.assertEqual(size, len(sink.getvalue()))
+
+        sink = bytearray()
+        template.render_to(sink, {}, returns_gzip)
+        self.assertEqual(
+            gzip.GzipFile(fileobj=io.BytesIO(sink)).read().decode('utf-8'),
+            expected)
+        self.assertRaises(TypeError, template.render_to,
+                          io.StringIO(), {}, returns_gzip)
+
+        # partial writes of a raw stream
+        class Raw(io.RawIOBase):
+            def __init__(self):
+                self.data = bytearray()
+            def writable(self):
+                return True
+            def write(self, data):
+                self.data.extend(data[:3])
+                return min(len(data), 3)
+        sink = Raw()
+        self.assertEqual(template.render_to(sink, {}), len(sink.data))
+        self.assertEqual(bytes(sink.data), expected.encode('utf-8'))
+
+        class Lines(list):
+            writelines = list.extend
+        sink = Lines()
+        template.render_to(sink, {}, buffer_size=0)
+        self.assertEqual(len(sink), 300)
+
+        a, b = socket.socketpair()
+        try:
+            template.render_to(a, {})
+            a.shutdown(socket.SHUT_WR)
+            received = b''.join(iter(lambda: b.recv(4096), b''))
+            self.assertEqual(received, expected.encode('utf-8'))
+        finally:
+            a.close()
+            b.close()
+
+    def test_fuse_yields(self):
+        body = ('<ul>\n<? for i in items: {?>\n'
+                '  <li><?=i?>, <?=i?></li>\n<?}?>\n</ul>')
+        for features, items in (('notgiven', ['a', 'b']),
+                                ('cast_string', [1, 2]),
+                                ('minify_html, trim_blocks', ['a', 'b'])):
+            header = '<?py from katagami import %s ?>' % features
+            plain = render_string(header + body, flags=returns_renderer)
+            fused = render_string(header.replace(' ?>', ', fuse_yields ?>')
+                                  + body, flags=returns_renderer)
+            self.assertEqual(fused({'items': items}),
+                             plain({'items': items}))
+            self.assertLess(
+                len(list(fused({'items': items}, returns_iter))),
+                len(list(plain({'items': items}, returns_iter))))
+
+        # __cast_string__ is looked up in locals and globals
+        template = render_string(
+            '<?py from katagami import cast_string, fuse_yields ?>'
+            '<b><?=1?></b>', flags=returns_renderer)
+        self.assertEqual(template({}), '<b>1</b>')
+        self.assertEqual(template({'__cast_string__': lambda o: '#'}),
+                         '<b>#</b>')
+
+        # the position of a type error is the expression
+        template = render_string(
+            '<?py from katagami import fuse_yields ?>\n'
+            '<b><?=a?></b>\n<i><?=b?></i>', flags=returns_renderer)
+        try:
+            template({'a': 'A', 'b': 1})
+        except TypeError:
+            filename, lineno, funcname, _ \
+                = traceback.extract_tb(sys.exc_info()[2])[-1]
+            self.assertEqual((filename, lineno), (template.name, 3))
+        else:
+            self.fail()
+
+        # except_hook is not fused
+        template = render_string(
+            '<?py from katagami import except_hook, fuse_yields ?>'
+            '<b><?=a?></b>', flags=returns_renderer)
+        self.assertNotIn('.join(', template.script)
+        self.assertIn('Can\'t convert', template({'a': 1}))
+
+    def test_fuse_loops(self):
+        body = ('<table>\n<? for row in rows: {?>\n  <tr>'
+                '<? for c in row: {?><td><?=c?>%<?=c * 2?></td><?}?>'
+                '</tr>\n<?}?>\n</table>')
+        rows = [['a', 'b'], [], ['c']] * 300
+        for features, rows in (('notgiven', rows),
+                               ('cast_string', [[1, 2], [3]]),
+                               ('minify_html, trim_blocks', rows)):
+            header = '<?py from katagami import %s ?>' % features
+            plain = render_string(header + body, flags=returns_renderer)
+            fused = render_string(header.replace(' ?>', ', fuse_loops ?>')
+                                  + body, flags=returns_renderer)
+            self.assertIn('__batches__(rows', fused.script)
+            self.assertEqual(fused({'rows': rows}), plain({'rows': rows}))
+            self.assertLess(
+                len(list(fused({'rows': rows}, returns_iter))),
+                len(list(plain({'rows': rows}, returns_iter))))
+
+        # the position of a type error is the expression
+        template = render_string(
+            '<?py from katagami import fuse_loops ?>\n'
+            '<? for i in items: {?>\n<b><?=i?></b>\n<?}?>',
+            flags=returns_renderer)
+        try:
+            template({'items': ['a', 1]})
+        except TypeError:
+            filename, lineno, funcname, _ \
+                = traceback.extract_tb(sys.exc_info()[2])[-1]
+            self.assertEqual((filename, lineno), (template.name, 3))
+        else:
+            self.fail()
+
+        # a loop with scripts, other blocks or else is not fused, but the
+        # inner loops are
+        for body in ('<? for row in rows: {?><?py n = 1 ?>'
+                     '<? for c in row: {?><?=c?><?}?><?}?>',
+                     '<? for row in rows: {?><? if row: {?>'
+                     '<? for c in row: {?><?=c?><?}?><?}?><?}?>',
+                     '<? for row in rows: {?><? for c in row: {?><?=c?><?}?>'
+                     '<?} else: {?>.<?}?>'):
+            template = render_string(
+                '<?py from katagami import fuse_loops ?>' + body,
+                flags=returns_renderer)
+            self.assertNotIn('__batches__(rows', template.script)
+            self.assertIn('__batches__(row,', template.script)
+            self.assertEqual(template({'rows': [['a', 'b'], ['c']]})
+                             .strip('.'), 'abc')
+
+    def test_render_limits(self):
+        template = render_string(
+            '<ul>\n<? for i in items: {?>\n  <li><?=str(i)?></li>\n<?}?></ul>',
+            flags=returns_renderer)
+
+        self.assertEqual(template({'items': range(3)}, max_output=1000),
+                         template({'items': range(3)}))
+
+        try:
+            template({'items': range(1000)}, max_output=100)
+        except RenderLimitError as e:
+            self.assertEqual((e.filename, e.lineno), (template.name, 3))
+        else:
+            self.fail()
+
+        # bytes are counted after encoding
+        template = render_string('<?="\u00e9" * 10?>',
+                                 flags=returns_renderer)
+        template({}, max_output=10)
+        self.assertRaises(RenderLimitError, template, {}, returns_bytes,
+                          max_output=10)
+
+        def slow():
+            while 1:
+                time.sleep(0.01)
+                yield 'x'
+        template = render_string('<? for i in items: {?><?=i?><?}?>',
+                                 flags=returns_renderer)
+        self.assertRaises(RenderLimitError, template, {'items': slow()},
+                          timeout=0.05)
+
+    def test_render_resource(self):
+        import shutil
+        import tempfile
+        import zipfile
+
+        path = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(path, 'katagami_test_pkg'))
+            with open(os.path.join(path, 'katagami_test_pkg',
+                                   '__init__.py'), 'w') as fp:
+                fp.write('__version__ = "1"\n')
+            os.mkdir(os.path.join(path, 'katagami_test_pkg', 'templates'))
+            with open(os.path.join(path, 'katagami_test_pkg', 'templates',
+                                   'a.html'), 'w') as fp:
+                fp.write('hello, <?=name?>')
+            # plain modules, top level and in a package
+            for name in ('katagami_test_mod.py', 'mod.html',
+                         'katagami_test_pkg/mod.py',
+                         'katagami_test_pkg/pkg_mod.html'):
+                with open(os.path.join(path, name), 'w') as fp:
+                    fp.write('' if name.endswith('.py')
+                             else os.path.basename(name))
+
+            archive = os.path.join(path, 'zipped.zip')
+            with zipfile.ZipFile(archive, 'w') as zf:
+                zf.writestr('katagami_test_zip/__init__.py', '')
+                zf.writestr('katagami_test_zip/a.html', 'zipped <?=name?>')
+
+            sys.path[:0] = [path, archive]
+            try:
+                self.assertEqual(render_resource(
+                    'katagami_test_pkg', 'templates/a.html',
+                    {'name': 'world'}), 'hello, world')
+                self.assertEqual(render_resource(
+                    'katagami_test_zip', 'a.html', {'name': 'world'}),
+                    'zipped world')
+                self.assertEqual(render_resource('katagami_test_mod',
+                                                 'mod.html'), 'mod.html')
+                self.assertEqual(render_resource('katagami_test_pkg.mod',
+                                                 'pkg_mod.html'),
+                                 'pkg_mod.html')
+
+                # cached by the package version
+                import katagami_test_pkg
+                a = render_resource('katagami_test_pkg', 'templates/a.html',
+                                    flags=returns_renderer)
+                self.assertIs(render_resource(
+                    katagami_test_pkg, 'templates/a.html',
+                    flags=returns_renderer), a)
+                katagami_test_pkg.__version__ = '2'
+                self.assertIsNot(render_resource(
+                    katagami_test_pkg, 'templates/a.html',
+                    flags=returns_renderer), a)
+
+                # or by the mtime of the resource without the version
+                del katagami_test_pkg.__version__
+                filename = os.path.join(path, 'katagami_test_pkg',
+                                        'templates', 'a.html')
+                with open(filename, 'w') as fp:
+                    fp.write('hi, <?=name?>')
+                mtime = time.time() + 10
+                os.utime(filename, (mtime, mtime))
+                self.assertEqual(render_resource(
+                    katagami_test_pkg, 'templates/a.html',
+                    {'name': 'world'}), 'hi, world')
+                with open(filename, 'w') as fp:
+                    fp.write('bye, <?=name?>')
+                os.utime(filename, (mtime + 1, mtime + 1))
+                self.assertEqual(render_resource(
+                    katagami_test_pkg, 'templates/a.html',
+                    {'name': 'world'}), 'bye, world')
+                self.assertEqual([i for i in _resource_cache
+                                  if i[0] == 'katagami_test_pkg'],
+                                 [('katagami_test_pkg', 'templates/a.html')])
+            finally:
+                del sys.path[:2]
+                for name in ('katagami_test_pkg', 'katagami_test_zip',
+                             'katagami_test_mod', 'katagami_test_pkg.mod'):
+                    sys.modules.pop(name, None)
+                for key in list(_resource_cache):
+                    if key[0].startswith('katagami_test_'):
+                        del _resource_cache[key]
+        finally:
+            shutil.rmtree(path)
+
+    def test_args(self):
+        template = render_string(
+            '<?args rows, sep=", ", *, end="."?>\n'
+            '<?=sep.join(rows)?><?=end?>', flags=returns_renderer)
+        self.assertIn('def __main__(rows, sep=", ", *, end="."):',
+                      template.script)
+        self.assertEqual(template._parameters, ('rows', 'sep', 'end'))
+        self.assertEqual(template({'rows': ['a', 'b']}), '\na, b.')
+        self.assertEqual(template({'rows': ['a', 'b'], 'end': '!'}),
+                         '\na, b!')
+        self.assertEqual(
+            list(template.render_many([{'rows': ['a']},
+                                       {'rows': ['b'], 'sep': '-'}])),
+            ['\na.', '\nb.'])
+        try:
+            template({})
+        except TypeError as e:
+            self.assertIn('template %s missing' % template.name, str(e))
+        else:
+            self.fail()
+
+        # parameters are local variables
+        main = [i for i in template.code.co_consts
+                if isinstance(i, types.CodeType)][0]
+        self.assertIn('rows', main.co_varnames)
+
+        for source in ('<?args a?><?args b?>', '<?args a b?>',
+                       '<?args *a?>', '<?args **a?>', '<?args a, /?>'):
+            self.assertRaises(SyntaxError, render_string, source)
+
+    def test_translation(self):
+        import shutil
+        import struct
+        import tempfile
+
+        class Translations(gettext.NullTranslations):
+            def gettext(self, message):
+                return {'Hello': 'Bonjour', 'World': 'Monde'}.get(
+                    message, message)
+
+        template = '<p><?_Hello?>, <?_=name?>!</p>'
+        translator = Translator(io.StringIO(template), Translations())
+        # the static message is folded into the literal
+        self.assertIn('yield "<p>Bonjour, "', translator.script)
+        self.assertEqual(translator({'name': 'World'}),
+                         '<p>Bonjour, Monde!</p>')
+        self.assertEqual(translator({'name': 'World',
+                                     '__gettext__': lambda s: s.lower()}),
+                         '<p>Bonjour, world!</p>')
+
+        # comments of the expression are stripped
+        commented = Translator(io.StringIO('<?_= name # c ?>'),
+                               Translations())
+        self.assertEqual(commented({'name': 'World'}), 'Monde')
+
+        # the translated messages survive recompiling
+        import pickle
+        state = translator.__getstate__()
+        state['_pickle_tag'] = None
+        loaded = Translator.__new__(Translator)
+        loaded.__setstate__(pickle.loads(pickle.dumps(state)))
+        self.assertEqual(loaded({'name': 'x'}), '<p>Bonjour, x!</p>')
+
+        # KatagamiTemplate compiles a variant for each locale
+        path = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(path, 'a.html'), 'w') as fp:
+                fp.write(template)
+            os.makedirs(os.path.join(path, 'fr', 'LC_MESSAGES'))
+            # a minimal .mo catalog
+            keys, values = b'Hello', b'Bonjour'
+            with open(os.path.join(path, 'fr', 'LC_MESSAGES', 'test.mo'),
+                      'wb') as fp:
+                fp.write(struct.pack('<7I', 0x950412de, 0, 1, 28, 36, 0, 0)
+                         + struct.pack('<2I', len(keys), 44)
+                         + struct.pack('<2I', len(values), 44 + len(keys) + 1)
+                         + keys + b'\0' + values + b'\0')
+
+            cache = {}
+            templates = KatagamiTemplate(path, cache=cache, domain='test',
+                                         localedir=path)
+            self.assertEqual(templates('a', {'name': 'x', 'locale': 'fr'}),
+                             '<p>Bonjour, x!</p>')
+            self.assertEqual(templates('a', {'name': 'x'}),
+                             '<p>Hello, x!</p>')
+            self.assertEqual(sorted(cache, key=str),
+                             [('a', 'fr'), ('a', None)])
+
+            # the catalog is loaded again by unpickling
+            loaded = pickle.loads(pickle.dumps(cache['a', 'fr']))
+            self.assertEqual(loaded({'name': 'Hello'}),
+                             '<p>Bonjour, Bonjour!</p>')
+
+            # warmed up for each locale
+            cache.clear()
+            self.assertEqual(templates.warm_up(2, locales=['fr', None]), {})
+            self.assertEqual(sorted(cache, key=str),
+                             [('a', 'fr'), ('a', None)])
+            self.assertEqual(cache['a', 'fr']({'name': 'x'}),
+                             '<p>Bonjour, x!</p>')
+            self.assertIs(cache['a', 'fr'].translations,
+                          templates._get_translations('fr'))
+        finally:
+            shutil.rmtree(path)
+
+    def test_search_path(self):
+        import shutil
+        import tempfile
+
+        root = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(root, i) for i in ('theme', 'default')]
+            for path, name in (('theme', 'a'), ('default', 'a'),
+                               ('default', 'b')):
+                if not os.path.isdir(os.path.join(root, path)):
+                    os.mkdir(os.path.join(root, path))
+                with open(os.path.join(root, path, name + '.html'),
+                          'w') as fp:
+                    fp.write('%s/%s' % (path, name))
+
+            templates = KatagamiTemplate(paths, cache={}, resolve_ttl=60,
+                                         missing_ttl=60)
+            self.assertEqual(templates('a', {}), 'theme/a')
+            self.assertEqual(templates('b', {}), 'default/b')
+            self.assertRaises(OSError, templates, 'c', {})
+            self.assertEqual(templates.warm_up(1), {})
+            self.assertEqual(sorted(templates.cache), ['a', 'b'])
+            self.assertEqual(templates.cache['a']({}), 'theme/a')
+
+            # hits and misses are remembered
+            stat = os.stat
+            calls = []
+            os.stat = lambda path: calls.append(path) or stat(path)
+            try:
+                for name in ('a', 'b', 'a', 'b'):
+                    templates(name, {})
+                self.assertRaises(OSError, templates, 'c', {})
+                self.assertEqual(calls, [])
+
+                templates.resolve_ttl = templates.missing_ttl = 0
+                templates._resolved.clear()
+                templates('b', {})
+                self.assertRaises(OSError, templates, 'c', {})
+                self.assertEqual(len(calls), 4)
+                self.assertEqual(len(templates._resolved), 0)
+
+                # the least recently used names are forgotten
+                templates.missing_ttl = 60
+                templates.max_resolved = 2
+                for name in ('c', 'd', 'e'):
+                    self.assertRaises(OSError, templates, name, {})
+                self.assertEqual(list(templates._resolved), ['d', 'e'])
+            finally:
+                os.stat = stat
+        finally:
+            shutil.rmtree(root)
+
+    def test_load_async(self):
+        import asyncio
+        import shutil
+        import tempfile
+
+        root = tempfile.mkdtemp()
+        loop = asyncio.new_event_loop()
+        try:
+            with open(os.path.join(root, 'a.html'), 'w') as fp:
+                fp.write('a <?=name?>')
+
+            created = []
+            class Templates(KatagamiTemplate):
+                def _create_template(self, *args):
+                    created.append(args)
+                    return KatagamiTemplate._create_template(self, *args)
+            templates = Templates(root, cache={}, resolve_ttl=60)
+
+            def run(function):
+                # call in the running loop and wait for the result
+                future = loop.create_future()
+                loop.call_soon(lambda: future.set_result(function()))
+                return loop.run_until_complete(future)
+
+            first, second = loop.run_until_complete(run(
+                lambda: asyncio.gather(templates.load_async('a'),
+                                       templates.load_async('a'))))
+            self.assertIs(first, second)
+            self.assertEqual(first({'name': 'x'}), 'a x')
+            self.assertEqual(len(created), 1)
+            self.assertEqual(templates._loading, {})
+
+            # a cache hit is done without the executor
+            future = run(lambda: templates.load_async('a'))
+            self.assertTrue(future.done())
+            self.assertIs(loop.run_until_complete(future), first)
+            self.assertEqual(len(created), 1)
+
+            self.assertRaises(OSError, loop.run_until_complete,
+                              run(lambda: templates.load_async('b')))
+            self.assertRaises(RuntimeError, templates.load_async, 'a')
+        finally:
+            loop.close()
+            shutil.rmtree(root)
+
+    def test_archive_loader(self):
+        import shutil
+        import tempfile
+        import zipfile
+
+        root = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root, 'templates.zip')
+            def deploy(version):
+                temporary = filename + '.tmp'
+                with zipfile.ZipFile(temporary, 'w',
+                                     zipfile.ZIP_DEFLATED) as zf:
+                    zf.writestr('a.html', 'a%d <?=name?>' % version)
+                    zf.writestr('sub/b.html', 'b%d' % version)
+                    zf.writestr('broken.html', '<?py if ?>')
+                os.rename(temporary, filename)
+
+            deploy(1)
+            loader = ArchiveLoader(filename, check_interval=0)
+            templates = KatagamiTemplate(loader=loader, cache={})
+            self.assertEqual(templates('a', {'name': 'x'}), 'a1 x')
+            self.assertEqual(templates('sub/b', {}), 'b1')
+            self.assertRaises(OSError, templates, 'c', {})
+            self.assertEqual(list(templates.warm_up(2)), ['broken'])
+            self.assertEqual(sorted(templates.cache), ['a', 'sub/b'])
+            self.assertEqual(templates.cache['a'].mtime, loader.stat('a.html'))
+
+            # a member is not read again from the archive path
+            compacted = KatagamiTemplate(loader=loader, cache={},
+                                         compact=True)
+            translator = compacted._create_template('a')
+            self.assertIn('yield "a1 "', translator.script)
+            state = translator.__getstate__()
+            state['_pickle_tag'] = None
+            unpickled = Translator.__new__(Translator)
+            unpickled.__setstate__(state)
+            self.assertEqual(unpickled({'name': 'x'}), 'a1 x')
+            self.assertEqual(unpickled._get_template_line(1),
+                             'a1 <?=name?>')
+
+            # replaced atomically, even with the same mtime
+            mtime = os.stat(filename).st_mtime
+            deploy(2)
+            os.utime(filename, (mtime, mtime))
+            self.assertEqual(templates('a', {'name': 'x'}), 'a2 x')
+            self.assertEqual(templates('sub/b', {}), 'b2')
+        finally:
+            shutil.rmtree(root)
+
+    def test_macro(self):
+        template = render_string(
+            '<?py from katagami import fuse_yields ?>'
+            '<? def cell(value, tag="td") {?><<?=tag?>><?=value?></<?=tag?>>'
+            '<?}?>'
+            '<? def empty(): {?><?}?>'
+            '<? for i in items: {?><?=cell(i)?><?=empty()?><?}?>'
+            '<?=cell("x", tag="th")?>',
+            flags=returns_renderer)
+        self.assertEqual(template({'items': ['a', 'b']}),
+                         '<td>a</td><td>b</td><th>x</th>')
+        self.assertIn('(cell(i)) or ()', template.script)
+
+        # errors in a macro point the macro body
+        template = render_string(
+            '<? def cell(value) {?>\n<td><?=value?></td><?}?>\n'
+            '<?=cell(1)?>', flags=returns_renderer)
+        try:
+            template({})
+        except TypeError:
+            filename, lineno, funcname, _ \
+                = traceback.extract_tb(sys.exc_info()[2])[-1]
+            self.assertEqual((lineno, funcname), (2, 'cell'))
+        else:
+            self.fail()
+
+        # errors of a macro call are given to __except_hook__
+        template = render_string(
+            '<?py from katagami import except_hook ?>'
+            '<? def cell(value) {?><?py 1 / value ?><td><?=value?></td>'
+            '<?}?><?=cell(0)?><?=cell()?>', flags=returns_renderer)
+        self.assertEqual(
+            template({'__except_hook__': lambda t, v, tb: t.__name__}),
+            'ZeroDivisionErrorTypeError')
+
+    def test_incremental_renderer(self):
+        calls = []
+        def count(name, value):
+            calls.append(name)
+            return value
+
+        template = render_string(
+            '<h1><?=count("title", title)?></h1>\n'
+            '<?py total = count("total", sum(rows)) ?>'
+            '<? for row in rows: {?><td><?=str(row)?></td><?}?>\n'
+            '<p><?=str(total)?></p>\n'
+            '<?py heading = title.upper() ?><i><?=heading?></i>',
+            flags=returns_renderer)
+        renderer = IncrementalRenderer(template)
+
+        def render(context, changed=None):
+            expected = template(dict(context))
+            del calls[:]
+            self.assertEqual(renderer.render(context, changed), expected)
+            return list(calls)
+
+        context = {'title': 'a', 'rows': [1, 2], 'count': count}
+        self.assertEqual(render(context), ['title', 'total'])
+
+        # only the affected segments are executed
+        context = dict(context, rows=[1, 2, 3])
+        self.assertEqual(render(context), ['total'])
+        context = dict(context, title='b')
+        self.assertEqual(render(context, ['title']), ['title'])
+
+        context = dict(context, title='c')
+        self.assertEqual([i[1] for i in renderer.render_changes(context)],
+                         ['c', 'C'])
+        # nothing changed
+        self.assertEqual(renderer.render_changes(context), [])
+
+        # mutated in place
+        context['rows'].append(5)
+        self.assertEqual(render(context), ['total'])
+
+        # only changed values are copied
+        class Rows(list):
+            copies = 0
+            def __deepcopy__(self, memo):
+                Rows.copies += 1
+                return Rows(self)
+        context = dict(context, rows=Rows([1]))
+        self.assertEqual(render(context), ['total'])
+        self.assertEqual(Rows.copies, 1)
+        self.assertEqual(render(dict(context, title='d')), ['title'])
+        self.assertEqual(render(dict(context, title='e'), ['title']),
+                         ['title'])
+        self.assertEqual(Rows.copies, 1)
+        # a value given with changed is compared again later
+        self.assertEqual(render(dict(context, title='e')), ['title'])
+
+        # a failed rendering is done again from scratch
+        self.assertRaises(TypeError, renderer.render,
+                          dict(context, rows=[1, None]))
+        self.assertEqual(render(dict(context, rows=[4])), ['title', 'total'])
+
+    def test_memoized_renderer(self):
+        import warnings
+
+        class Counter(object):
+            count = 0
+            def __call__(self):
+                self.count += 1
+                return str(self.count)
+
+        template = render_string('<?=counter()?><?=name?>',
+                                 flags=returns_renderer)
+        counter = Counter()
+        context = lambda name, **kwargs: dict(kwargs, name=name,
+                                              counter=counter)
+
+        # equal values of different types
+        renderer = MemoizedRenderer(render_string(
+            '<?=str(x)?>', flags=returns_renderer))
+        self.assertEqual([renderer({'x': i}) for i in (1, True, 1.0, 1)],
+                         ['1', 'True', '1.0', '1'])
+
+        renderer = MemoizedRenderer(template, maxsize=2, ttl=60)
+        self.assertEqual(renderer(context('a')), '1a')
+        self.assertEqual(renderer(context('a')), '1a')
+        self.assertEqual(list(renderer(context('a'), returns_iter)), ['2a'])
+        self.assertEqual(renderer(context('b')), '3b')
+        # LRU
+        self.assertEqual(renderer(context('c')), '4c')
+        self.assertEqual(renderer(context('b')), '3b')
+        self.assertEqual(renderer(context('a')), '5a')
+        self.assertEqual((renderer.hits, renderer.misses), (2, 5))
+        # unhashable context is not cached
+        self.assertEqual(renderer(context('a', rows=[])), '6a')
+        self.assertEqual(renderer(context('a', rows=[])), '7a')
+        # user-supplied key
+        renderer.key = lambda context: context['name']
+        self.assertEqual(renderer(context('a', rows=[])), '8a')
+        self.assertEqual(renderer(context('a', rows=[])), '8a')
+        # TTL
+        renderer.ttl = -1
+        renderer.clear()
+        self.assertEqual(renderer(context('d')), '9d')
+        self.assertEqual(renderer(context('d')), '10d')
+
+        # impurities are warned
+        template = render_string(
+            '<?py\nimport time\n?>\n<?=str(time.time())?>\n'
+            '<?py holder.value = 1 ?>', flags=returns_renderer)
+        self.assertEqual([i[0] for i in find_impurities(template)],
+                         [2, 4, 5])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            MemoizedRenderer(template)
+        self.assertEqual(len(caught), 3)
+        self.assertEqual(find_impurities(render_string(
+            '<? for i in items: {?><?=i?><?}?>', flags=returns_renderer)),
+            [])
+
+    def test_compact(self):
+        layout = '<html>' + 'x' * 1000 + '</html>'
+        a = render_string(layout + '<?=a?>', flags=returns_renderer)
+        b = render_string(layout + '<?=a\n?>', flags=returns_renderer)
+        # only attributes set by users are in __dict__
+        self.assertEqual(a.__dict__, {})
+        b.gzip_level = 9
+        b.owner = 'test'
+        self.assertEqual(vars(b), {'gzip_level': 9, 'owner': 'test'})
+        state = b.__getstate__()
+        state['_pickle_tag'] = None
+        c = Translator.__new__(Translator)
+        c.__setstate__(state)
+        self.assertEqual(vars(c), {'gzip_level': 9, 'owner': 'test'})
+        del b.gzip_level, b.owner
+
+        usage = a.memory_usage()
+        script = a.script
+        self.assertIs(a.compact(), a)
+        b.compact()
+        self.assertLess(a.memory_usage(), usage)
+        self.assertEqual(a._template_body, layout + '<?=a?>')
+        self.assertEqual(a({'a': 'A'}), layout + 'A')
+
+        # the same literal chunks share memory
+        main = lambda t: [i for i in t.code.co_consts
+                          if isinstance(i, types.CodeType)][0]
+        const = lambda t: [i for i in main(t).co_consts if i == layout][0]
+        self.assertIs(const(a), const(b))
+
+        # lazily reloaded, without linecache for an anonymous template
+        linecache.clearcache()
+        self.assertEqual(a.script, script)
+        self.assertIsNone(a._script)
+        self.assertEqual(a._get_template_line(1), layout + '<?=a?>')
+
+        # the lost source is an error
+        a._template_body = None
+        self.assertRaises(OSError, getattr, a, 'script')
+        a._template_body = layout + '<?=a?>'
+
+        # a compacted anonymous template can be pickled
+        state = a.__getstate__()
+        state['_pickle_tag'] = None
+        loaded = Translator.__new__(Translator)
+        loaded.__setstate__(state)
+        self.assertEqual(loaded({'a': 'A'}), layout + 'A')
+
+    def test_unbalanced_brace(self):
+        for template, lineno in (('x<?}?>y', 1), (b'x\n<?}?>y', 2)):
+            try:
+                render_string(template)
+            except IndentationError as e:
+                self.assertEqual(e.lineno, lineno)
+                self.assertEqual(e.text, '<?}?>y' if lineno > 1 else 'x<?}?>y')
+            else:
+                self.fail()
+
+        # an error of <?args?> followed by a literal
+        try:
+            render_string('<?args a=?>x')
+        except SyntaxError as e:
+            self.assertEqual((e.lineno, e.text), (1, '<?args a=?>x'))
+        else:
+            self.fail()
+
     def test_error_position_mod(self):
         try:
             self.render('<?= 1 ?>', 3, 7)
@@ -1436,6 +4983,28 @@ class Test(unittest.TestCase):
     sys.modules[__main__.__name__] = __main__
     target = __main__
 
+    if sys.argv[1:2] == ['warm-up']:
+        import argparse
+        parser = argparse.ArgumentParser(
+            prog='%s warm-up' % os.path.basename(__file__),
+            description='Compile templates in parallel and report errors.')
+        parser.add_argument('paths', nargs='+', metavar='PATH',
+                            help='template file or directory')
+        parser.add_argument('-j', '--workers', type=int, default=None,
+                            help='number of worker processes')
+        parser.add_argument('--suffix', default='.html',
+                            help='suffix of template files in directories')
+        args = parser.parse_args(sys.argv[2:])
+
+        errors = 0
+        for filename, (mtime, result) in sorted(warm_up(
+                args.paths, args.workers, args.suffix).items()):
+            if isinstance(result, Exception):
+                print(format_template_error(filename, result),
+                      file=sys.stderr)
+                errors += 1
+        sys.exit(1 if errors else 0)
+
     if 'check' in sys.argv:
         unittest.main(argv=sys.argv[:1], exit=False)
         doctest.testmod()